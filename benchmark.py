@@ -0,0 +1,420 @@
+# Offline throughput benchmark for the transfer pipeline.
+#
+# Runs the real job path (run_job -> recursive_process -> aria2c -> upload) against
+# a local fake Drive API and a fake Telegram client, over synthetic trees, and
+# prints one JSON object with files/s, MB/s, peak RSS and peak scratch disk per
+# scenario. Needs aria2c on PATH, like the bot itself; no Drive or Telegram account.
+#
+#   python benchmark.py                         # all scenarios
+#   python benchmark.py tiny deep --latency-ms 50 --drive-mbps 20 --output bench.json
+#   python benchmark.py --stream                # STREAM_MODE (diskless) instead of aria2c
+#   python benchmark.py deep deep               # second run is served from the dedup index
+
+import io
+import os
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+import tempfile
+import shutil
+import random
+import contextlib
+import enum
+import types
+import psutil
+from aiohttp import web
+
+DEFAULT_SCENARIOS = ("tiny", "huge", "deep")
+CHUNK = 256 * 1024
+UPLOAD_PART = 512 * 1024 # Pyrogram's upload part size
+PATTERN = bytes(range(256)) * 4096 # 1 MiB filler; every file gets its own header, so md5s differ
+FOLDER_MIME = 'application/vnd.google-apps.folder'
+
+# --- SYNTHETIC TREES ---
+class FakeTree:
+    def __init__(self, name):
+        self.name = name
+        self.items = {} # id -> Drive item
+        self.children = {} # folder id -> [items]
+        self.root = self.folder(None, name)
+
+    def folder(self, parent, name):
+        item = {'id': f"fld{len(self.items)}", 'name': name, 'mimeType': FOLDER_MIME, 'modifiedTime': "2024-01-01T00:00:00.000Z"}
+        self.add(parent, item)
+        self.children[item['id']] = []
+        return item
+
+    def file(self, parent, name, size):
+        file_id = f"file{len(self.items)}"
+        item = {'id': file_id, 'name': name, 'mimeType': 'application/octet-stream', 'size': str(size), 'modifiedTime': "2024-01-01T00:00:00.000Z"}
+        md5 = hashlib.md5()
+        for chunk in file_chunks(file_id, 0, size): md5.update(chunk)
+        item['md5Checksum'] = md5.hexdigest()
+        self.add(parent, item)
+        return item
+
+    def add(self, parent, item):
+        self.items[item['id']] = item
+        if parent: self.children[parent['id']].append(item)
+
+    def files(self):
+        return [i for i in self.items.values() if i['mimeType'] != FOLDER_MIME]
+
+def file_chunks(file_id, start, end):
+    # Content of a fake file: 64-byte header (its id) followed by PATTERN, repeated
+    header = file_id.encode().ljust(64, b"\0")
+    pos = start
+    while pos < end:
+        if pos < len(header):
+            chunk = header[pos:min(end, len(header))]
+        else:
+            offset = (pos - len(header)) % len(PATTERN)
+            chunk = PATTERN[offset:offset + min(end - pos, CHUNK, len(PATTERN) - offset)]
+        pos += len(chunk)
+        yield chunk
+
+def build_tree(name, scale):
+    tree = FakeTree(f"bench-{name}")
+    if name == "tiny":
+        # Many small files: per-file overhead (listing, RPC, status, upload calls) dominates
+        for f in range(max(1, int(10 * scale))):
+            folder = tree.folder(tree.root, f"Folder {f}")
+            for n in range(50): tree.file(folder, f"file_{n}.bin", 64 * 1024)
+    elif name == "huge":
+        # A few files above the split limit: raw download/upload throughput and splitting
+        for n in range(max(1, int(3 * scale))): tree.file(tree.root, f"huge_{n}.bin", 768 * 1024 * 1024)
+    elif name == "deep":
+        # Deep nesting: listing latency and folder header/checkpoint handling
+        folder = tree.root
+        for depth in range(max(1, int(12 * scale))):
+            for n in range(3): tree.file(folder, f"d{depth}_{n}.bin", 1024 * 1024)
+            folder = tree.folder(folder, f"Level {depth + 1}")
+    else: raise SystemExit(f"Unknown scenario: {name}")
+    return tree
+
+# --- FAKE DRIVE ---
+class FakeDrive:
+    # files.list (paged), files.get and alt=media with Range support, behind
+    # a fixed per-request latency and a per-connection bandwidth cap.
+    def __init__(self, latency, bandwidth):
+        self.latency = latency
+        self.bandwidth = bandwidth # bytes/s per response, 0 = unlimited
+        self.tree = None
+        self.requests = 0
+
+    def app(self):
+        app = web.Application()
+        app.add_routes([web.get('/drive/v3/files', self.list_files), web.get('/drive/v3/files/{file_id}', self.get_file)])
+        return app
+
+    async def list_files(self, request):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        query = request.query.get('q', "")
+        parent = query.split("'")[1] if "'" in query else ""
+        items = self.tree.children.get(parent, [])
+        start = int(request.query.get('pageToken') or 0)
+        page_size = min(int(request.query.get('pageSize') or 100), 1000)
+        page = {'files': items[start:start + page_size]}
+        if start + page_size < len(items): page['nextPageToken'] = str(start + page_size)
+        return web.json_response(page)
+
+    async def get_file(self, request):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        item = self.tree.items.get(request.match_info['file_id'])
+        if not item: return web.json_response({'error': {'code': 404, 'message': "File not found"}}, status=404)
+        if request.query.get('alt') != 'media': return web.json_response(item)
+
+        size = int(item['size'])
+        start, end = 0, size
+        headers = {'Accept-Ranges': 'bytes'}
+        if request.http_range.start is not None or request.http_range.stop is not None:
+            start = request.http_range.start or 0
+            end = min(request.http_range.stop or size, size)
+            headers['Content-Range'] = f"bytes {start}-{end - 1}/{size}"
+        response = web.StreamResponse(status=206 if 'Content-Range' in headers else 200, headers=headers)
+        response.content_length = end - start
+        await response.prepare(request)
+        began = time.monotonic()
+        sent = 0
+        for chunk in file_chunks(item['id'], start, end):
+            await response.write(chunk)
+            sent += len(chunk)
+            if self.bandwidth:
+                ahead = sent / self.bandwidth - (time.monotonic() - began)
+                if ahead > 0: await asyncio.sleep(ahead)
+        await response.write_eof()
+        return response
+
+# --- FAKE TELEGRAM ---
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+
+class FakeMedia(enum.Enum):
+    DOCUMENT = "document"
+
+class FakeMessage:
+    def __init__(self, client, chat_id, message_id, text="", file_id=None):
+        self.client = client
+        self.chat = FakeChat(chat_id)
+        self.id = message_id
+        self.text = text
+        self.media = FakeMedia.DOCUMENT if file_id else None
+        self.document = types.SimpleNamespace(file_id=file_id) if file_id else None
+
+    async def edit(self, text):
+        self.client.edits += 1
+        self.text = text
+
+    async def delete(self): pass
+
+    async def reply_text(self, text, **kwargs):
+        return await self.client.send_message(self.chat.id, text)
+
+class FakeTelegram:
+    # Stands in for the Pyrogram client: uploads read the whole source in 512 KiB
+    # parts (like saveBigFilePart), report progress and are throttled to `bandwidth`.
+    # Streamed uploads arrive as raw upload.saveFilePart/saveBigFilePart calls.
+    def __init__(self, latency, bandwidth):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.next_id = 0
+        self.edits = 0
+        self.uploads = 0
+        self.uploaded_bytes = 0
+        self.cached_sends = 0
+
+    def message(self, chat_id, text="", file_id=None):
+        self.next_id += 1
+        return FakeMessage(self, chat_id, self.next_id, text, file_id)
+
+    def media_message(self, chat_id):
+        self.uploads += 1
+        return self.message(chat_id, file_id=f"fake-file-{self.next_id + 1}")
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.latency)
+        return self.message(chat_id, text)
+
+    async def pin_chat_message(self, chat_id, message_id, **kwargs): pass
+
+    async def send_document(self, chat_id, document, progress=None, progress_args=(), **kwargs):
+        return await self.upload(chat_id, document, progress, progress_args)
+
+    async def send_video(self, chat_id, video, progress=None, progress_args=(), **kwargs):
+        return await self.upload(chat_id, video, progress, progress_args)
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        # One request for the whole album: the parts go out back to back, one round trip at the end
+        sent = []
+        for item in media:
+            sent.append(await self.upload(chat_id, item.media, None, (), latency=False))
+        await asyncio.sleep(self.latency)
+        return sent
+
+    async def copy_message(self, chat_id, from_chat_id, message_id, **kwargs):
+        await asyncio.sleep(self.latency)
+        return self.message(chat_id, file_id=f"fake-file-{message_id}")
+
+    async def send_cached_media(self, chat_id, file_id, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.cached_sends += 1
+        return self.message(chat_id, file_id=file_id)
+
+    async def delete_messages(self, chat_id, message_ids, **kwargs): pass
+
+    def rnd_id(self): return random.getrandbits(63)
+
+    def guess_mime_type(self, name): return None
+
+    async def invoke(self, query):
+        # Only file parts; the message itself goes through send_uploaded (see main)
+        if self.bandwidth: await asyncio.sleep(len(query.bytes) / self.bandwidth)
+        else: await asyncio.sleep(0)
+        self.uploaded_bytes += len(query.bytes)
+        return True
+
+    async def send_uploaded(self, chat_id):
+        await asyncio.sleep(self.latency)
+        return self.media_message(chat_id)
+
+    async def save_file(self, path, progress=None, progress_args=(), **kwargs):
+        # Parts only, like Pyrogram's save_file; the message comes from send_uploaded (see main)
+        done = await self.transfer(path, progress, progress_args)
+        self.uploaded_bytes += done
+        return types.SimpleNamespace(name=getattr(path, 'name', path))
+
+    async def upload(self, chat_id, source, progress, progress_args, latency=True):
+        done = await self.transfer(source, progress, progress_args)
+        if latency: await asyncio.sleep(self.latency)
+        self.uploaded_bytes += done
+        return self.media_message(chat_id)
+
+    async def transfer(self, source, progress, progress_args):
+        # Pyrogram only closes files it opened itself
+        f = open(source, 'rb') if isinstance(source, str) else source
+        try:
+            total = f.seek(0, io.SEEK_END)
+            f.seek(0)
+            began = time.monotonic()
+            done = 0
+            while True:
+                part = f.read(UPLOAD_PART)
+                if not part: break
+                done += len(part)
+                if self.bandwidth:
+                    ahead = done / self.bandwidth - (time.monotonic() - began)
+                    if ahead > 0: await asyncio.sleep(ahead)
+                else: await asyncio.sleep(0)
+                if progress: await progress(done, total, *progress_args)
+        finally:
+            if isinstance(source, str): f.close()
+        return done
+
+# --- RUNNER ---
+class Sampler:
+    # Peak RSS (this process + aria2c) and peak bytes on disk in the scratch dir
+    def __init__(self, scratch_dir, interval=0.1):
+        self.scratch_dir = scratch_dir
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_disk = 0
+
+    def sample(self):
+        me = psutil.Process()
+        rss = me.memory_info().rss
+        for child in me.children(recursive=True):
+            try: rss += child.memory_info().rss
+            except psutil.Error: pass
+        disk = 0
+        for entry in os.scandir(self.scratch_dir):
+            try: disk += entry.stat().st_blocks * 512
+            except OSError: pass
+        self.peak_rss = max(self.peak_rss, rss)
+        self.peak_disk = max(self.peak_disk, disk)
+
+    async def run(self):
+        while True:
+            self.sample()
+            await asyncio.sleep(self.interval)
+
+async def run_scenario(bot, drive, telegram, name, args):
+    tree = build_tree(name, args.scale)
+    drive.tree = tree
+    requests_before, uploads_before, bytes_before, cached_before = drive.requests, telegram.uploads, telegram.uploaded_bytes, telegram.cached_sends
+
+    user_id = chat_id = 1
+    journal = bot.JobJournal.create(user_id, chat_id, [(tree.root['name'], tree.root)], [], False)
+    job = bot.Job(journal, await telegram.send_message(user_id, "bench"))
+    job.state = 'running'
+    bot.scheduler.active[job.job_id] = job
+
+    sampler = Sampler(bot.storage.directory)
+    sampling = asyncio.create_task(sampler.run())
+    started = time.monotonic()
+    try: await bot.run_job(telegram, job)
+    finally:
+        elapsed = time.monotonic() - started
+        sampling.cancel()
+        sampler.sample()
+        bot.scheduler.active.pop(job.job_id, None)
+
+    files = tree.files()
+    size = sum(int(i['size']) for i in files)
+    return {
+        'files': len(files),
+        'bytes': size,
+        'uploads': telegram.uploads - uploads_before,
+        'cached_sends': telegram.cached_sends - cached_before,
+        'uploaded_bytes': telegram.uploaded_bytes - bytes_before,
+        'errors': job.pipeline.errors if job.pipeline else None,
+        'drive_requests': drive.requests - requests_before,
+        'seconds': round(elapsed, 3),
+        'files_per_s': round(len(files) / elapsed, 2),
+        'mb_per_s': round(size / elapsed / 1e6, 2),
+        'peak_rss_mb': round(sampler.peak_rss / 1e6, 1),
+        'peak_disk_mb': round(sampler.peak_disk / 1e6, 1),
+    }
+
+def load_bot(args, work_dir):
+    # bot reads its configuration at import time
+    os.environ.update({
+        'API_ID': os.environ.get('API_ID', "1"), 'API_HASH': os.environ.get('API_HASH', "bench"),
+        'BOT_TOKEN': os.environ.get('BOT_TOKEN', "0:bench"),
+        'MANIFEST_DB': os.path.join(work_dir, "manifest.db"),
+        'SCRATCH_DIR': os.path.join(work_dir, "scratch"),
+        'PROBE_CACHE_DIR': os.path.join(work_dir, "probe_cache"),
+        'DRIVE_API_URL': f"http://127.0.0.1:{args.port}/drive/v3",
+        'ARIA2_RPC_URL': f"http://127.0.0.1:{args.aria2_port}/jsonrpc",
+        'STREAM_MODE': "true" if args.stream else "false",
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot
+    bot.SPLIT_LIMIT = args.split_limit_mb * 1024 * 1024
+    return bot
+
+def bench_credentials():
+    import google.oauth2.credentials
+
+    class BenchCredentials(google.oauth2.credentials.Credentials):
+        def refresh(self, request): self.token = "bench"
+
+    return BenchCredentials(token="bench")
+
+async def main(args):
+    work_dir = tempfile.mkdtemp(prefix="drive_bench_")
+    try:
+        bot = load_bot(args, work_dir)
+        bot.accounts.accounts = [bot.ServiceAccount("bench", bench_credentials())]
+        async def send_uploaded_media(client, chat_id, *args, **kwargs): return await client.send_uploaded(chat_id)
+        bot.send_uploaded_media = send_uploaded_media
+        @contextlib.asynccontextmanager
+        async def media_session(client): yield client # Streamed parts go to the fake's invoke
+        bot.media_session = media_session
+
+        drive = FakeDrive(args.latency_ms / 1000, args.drive_mbps * 1e6)
+        telegram = FakeTelegram(args.latency_ms / 1000, args.upload_mbps * 1e6)
+        runner = web.AppRunner(drive.app())
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', args.port).start()
+        await bot.aria2.start()
+        try:
+            results = {}
+            for n, name in enumerate(args.scenarios):
+                # A repeated scenario re-sends content already uploaded (dedup path)
+                key = name if name not in results else f"{name}#{n + 1}"
+                results[key] = await run_scenario(bot, drive, telegram, name, args)
+        finally:
+            await bot.aria2.stop()
+            await bot.drive.close()
+            await runner.cleanup()
+        return {
+            'settings': {k: v for k, v in vars(args).items() if k != 'output'},
+            'scenarios': results,
+        }
+    finally: shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline Drive -> Telegram pipeline benchmark")
+    parser.add_argument("scenarios", nargs="*", default=list(DEFAULT_SCENARIOS), help="tiny, huge, deep")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplies file/folder counts")
+    parser.add_argument("--latency-ms", type=float, default=20, help="Added to every Drive/Telegram request")
+    parser.add_argument("--drive-mbps", type=float, default=0, help="Per-connection Drive bandwidth, MB/s (0: unlimited)")
+    parser.add_argument("--upload-mbps", type=float, default=0, help="Per-upload Telegram bandwidth, MB/s (0: unlimited)")
+    parser.add_argument("--stream", action="store_true", help="Run with STREAM_MODE (Drive -> Telegram, no disk)")
+    parser.add_argument("--split-limit-mb", type=int, default=256, help="Split size, so 'huge' splits without 2 GB files")
+    parser.add_argument("--port", type=int, default=18080, help="Fake Drive port")
+    parser.add_argument("--aria2-port", type=int, default=16800, help="RPC port for the benchmark's own aria2c")
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = asyncio.run(main(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f: f.write(text)
@@ -1,3 +1,4 @@
+import io
 import os
 import time
 import math
@@ -5,13 +6,22 @@ import asyncio
 import shutil
 import re
 import json
+import sqlite3
 import subprocess
+import secrets
+import hashlib
+import random
+import datetime
+import aiohttp
+import contextlib
 import google.auth.transport.requests
 from aiohttp import web
-from pyrogram import Client, filters, idle
-from pyrogram.types import BotCommand
+from pyrogram import Client, filters, idle, raw, utils
+from pyrogram.session import Session
+from pyrogram.types import BotCommand, Message, InputMediaDocument, InputMediaVideo
+from pyrogram.errors import FloodWait, MessageNotModified, FilePartMissing
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 
 # --- CONFIGURATION ---
 API_ID = int(os.environ.get("API_ID"))
@@ -25,18 +35,73 @@ if CREDENTIALS_JSON:
 
 SCOPES = ['https://www.googleapis.com/auth/drive']
 SERVICE_ACCOUNT_FILE = 'credentials.json'
+SERVICE_ACCOUNTS_DIR = os.environ.get("SERVICE_ACCOUNTS_DIR", "accounts") # More service account .json files, rotated with credentials.json
+QUOTA_COOLDOWN = int(os.environ.get("QUOTA_COOLDOWN", 6 * 3600)) # Seconds an account rests after hitting Drive's download quota
+RATE_COOLDOWN = int(os.environ.get("RATE_COOLDOWN", 60)) # Seconds an account rests after a rate limit
+ACCOUNT_SWITCHES = max(0, int(os.environ.get("ACCOUNT_SWITCHES", 3))) # Accounts tried per request after Drive limits before giving up
+TOKEN_MARGIN = int(os.environ.get("TOKEN_MARGIN", 600)) # Access tokens are renewed in the background this long before expiry
 CONFIG_FILE = "config.json"
+MANIFEST_DB = os.environ.get("MANIFEST_DB", "manifest.db")
+SPLIT_LIMIT = int(1.9 * 1024 * 1024 * 1024) # Max bytes per uploaded file/part
+PREFETCH_DEPTH = max(1, int(os.environ.get("PREFETCH_DEPTH", 3))) # Files downloaded ahead of the uploader
+MAX_ACTIVE_JOBS = max(1, int(os.environ.get("MAX_ACTIVE_JOBS", 3))) # Jobs running at once (all users)
+MAX_JOBS_PER_USER = max(1, int(os.environ.get("MAX_JOBS_PER_USER", 1))) # Jobs running at once per user
+MAX_DOWNLOADS = max(1, int(os.environ.get("MAX_DOWNLOADS", 6))) # Concurrent downloads, shared fairly by jobs
+MAX_UPLOADS = max(1, int(os.environ.get("MAX_UPLOADS", 3))) # Concurrent uploads, shared fairly by jobs
+UPLOAD_AHEAD = os.environ.get("UPLOAD_AHEAD", "true").lower() == "true" # Upload prefetched files before their turn, post them in order
+PROBE_WORKERS = max(1, int(os.environ.get("PROBE_WORKERS", 2))) # Concurrent ffprobe/ffmpeg runs
+PROBE_CACHE_DIR = os.environ.get("PROBE_CACHE_DIR", "probe_cache") # Cached thumbnails, named by md5
+VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.avi', '.mov', '.webm')
+SCRATCH_DIR = os.environ.get("SCRATCH_DIR", ".") # Where downloads are written
+SCRATCH_QUOTA = int(os.environ.get("SCRATCH_QUOTA", 0)) # Max bytes of downloads on disk at once (0: free space only)
+DISK_HEADROOM = int(os.environ.get("DISK_HEADROOM", 256 * 1024 * 1024)) # Free space always left untouched
+VIDEO_SPLIT = os.environ.get("VIDEO_SPLIT", "true").lower() == "true" # Cut oversized videos into playable segments (false: byte parts)
+VERIFY_DOWNLOADS = os.environ.get("VERIFY_DOWNLOADS", "true").lower() == "true" # Check Drive md5/size of every download
+VERIFY_RETRIES = int(os.environ.get("VERIFY_RETRIES", 2)) # Re-downloads after a checksum mismatch
+BATCH_FILE_LIMIT = int(os.environ.get("BATCH_FILE_LIMIT", 10 * 1024 * 1024)) # Files up to this size go out in media groups (0: off)
+BATCH_SIZE = 10 # Telegram's media group limit
+STREAM_MODE = os.environ.get("STREAM_MODE", "false").lower() == "true" # Stream non-video files Drive -> Telegram, no disk
+STREAM_BUFFER = int(os.environ.get("STREAM_BUFFER", 16 * 1024 * 1024)) # Bytes held in memory per streamed file
+STATUS_EDITS_PER_MINUTE = max(1, int(os.environ.get("STATUS_EDITS_PER_MINUTE", 20))) # Status edits per chat
+WALK_CONCURRENCY = max(1, int(os.environ.get("WALK_CONCURRENCY", 8))) # Parallel Drive folder listings
+DRIVE_API_URL = os.environ.get("DRIVE_API_URL", "https://www.googleapis.com/drive/v3")
+DRIVE_CONNECTIONS = max(1, int(os.environ.get("DRIVE_CONNECTIONS", 32))) # Keep-alive connections to the Drive API (listings + streams)
+DRIVE_RETRIES = int(os.environ.get("DRIVE_RETRIES", 5)) # Retries of a Drive API call on 5xx/network errors
+ARIA2_RPC_URL = os.environ.get("ARIA2_RPC_URL", "http://127.0.0.1:6800/jsonrpc")
+ARIA2_RPC_SECRET = os.environ.get("ARIA2_RPC_SECRET") or secrets.token_hex(16)
+ARIA2_SPAWN = os.environ.get("ARIA2_SPAWN", "true").lower() == "true" # false -> use an already running aria2 RPC server
+FOLDER_MIME = 'application/vnd.google-apps.folder'
+GOOGLE_APPS_MIME = 'application/vnd.google-apps.' # Docs, Sheets, shortcuts...: no bytes to download
+DRIVE_FILE_FIELDS = "id, name, mimeType, size, md5Checksum, modifiedTime, capabilities(canDownload)"
+DRIVE_LIST_FIELDS = f"nextPageToken, files({DRIVE_FILE_FIELDS})"
 
 # --- INITIALIZE BOT ---
-bot = Client("aria2_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+# Every upload opens its own media session; Pyrogram allows one at a time unless told otherwise
+bot = Client("aria2_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN, max_concurrent_transmissions=MAX_UPLOADS)
 
 # Global Variables
 user_data = {}
-STOP_PROCESS = False
-FOLDER_INDEX = []
-SKIP_UNTIL_NAME = None 
-FOUND_START_FILE = False 
-GLOBAL_SKIP_LIST = [] # New: List of names to skip everywhere
+
+# --- METRICS ---
+# Served on /metrics. Byte counters are totals; Prometheus' rate() turns them into bytes/s.
+DOWNLOADED_BYTES = Counter("drive_uploader_downloaded_bytes", "Bytes downloaded from Drive")
+UPLOADED_BYTES = Counter("drive_uploader_uploaded_bytes", "Bytes uploaded to Telegram")
+STAGE_SECONDS = Histogram("drive_uploader_stage_seconds", "Time spent per pipeline stage", ["stage"],
+                          buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
+FLOODWAITS = Counter("drive_uploader_floodwaits", "Telegram FloodWait errors", ["operation"])
+FLOODWAIT_SECONDS = Counter("drive_uploader_floodwait_seconds", "Seconds Telegram told us to wait", ["operation"])
+RETRIES = Counter("drive_uploader_retries", "Operations retried after an error", ["operation"])
+DRIVE_ACCOUNT_BYTES = Counter("drive_uploader_account_downloaded_bytes", "Bytes downloaded per service account", ["account"])
+DRIVE_LIMITS = Counter("drive_uploader_drive_limits", "Drive quota/rate limit errors per service account", ["account"])
+VERIFY_TAIL_BYTES = Counter("drive_uploader_verify_tail_bytes", "Bytes hashed after their download had finished")
+DEDUP_HITS = Counter("drive_uploader_dedup_hits", "Files/parts re-sent by Telegram file_id instead of transferred")
+Gauge("drive_uploader_jobs_active", "Jobs running or paused").set_function(lambda: len(scheduler.active))
+Gauge("drive_uploader_jobs_queued", "Jobs waiting for a slot").set_function(lambda: sum(len(q) for q in scheduler.waiting.values()))
+Gauge("drive_uploader_pipeline_queue_depth", "Files/folders queued for upload, all jobs").set_function(
+    lambda: sum(j.pipeline.queue.qsize() for j in scheduler.active.values() if j.pipeline))
+Gauge("drive_uploader_status_edits_pending", "Status edits waiting to be sent").set_function(lambda: sum(len(q) for q in status.pending.values()))
+Gauge("drive_uploader_scratch_reserved_bytes", "Scratch space reserved by downloads").set_function(
+    lambda: sum(size for size, _ in storage.reserved.values()))
 
 # --- CONFIG MANAGEMENT ---
 def load_config():
@@ -49,34 +114,452 @@ def load_config():
 def save_config(data):
     with open(CONFIG_FILE, "w") as f: json.dump(data, f)
 
-# --- HELPER FUNCTIONS ---
+# Modes like sync/dry run belong to whoever toggled them, not to every user of the bot
+def user_setting(uid, key):
+    return load_config().get("users", {}).get(str(uid), {}).get(key, False)
 
-def get_video_attributes(file_path):
-    try:
-        cmd = ["ffprobe", "-v", "error", "-select_streams", "v:0",
-               "-show_entries", "stream=width,height,duration",
-               "-of", "default=noprint_wrappers=1:nokey=1", file_path]
-        output = subprocess.check_output(cmd).decode("utf-8").strip().split("\n")
-        width = int(output[0]) if len(output) > 0 and output[0].isdigit() else 0
-        height = int(output[1]) if len(output) > 1 and output[1].isdigit() else 0
-        duration = 0
-        if len(output) > 2:
-            try: duration = int(float(output[2]))
-            except: pass
-        return width, height, duration
-    except: return 0, 0, 0
+def toggle_user_setting(uid, key):
+    config = load_config()
+    settings = config.setdefault("users", {}).setdefault(str(uid), {})
+    settings[key] = not settings.get(key, False)
+    save_config(config)
+    return settings[key]
 
-async def generate_thumbnail(video_path):
-    thumb_path = f"{video_path}.jpg"
-    try:
-        await asyncio.to_thread(subprocess.run, 
-            ["ffmpeg", "-i", video_path, "-ss", "00:00:02", "-vframes", "1", thumb_path],
-            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True
+# --- MANIFEST ---
+# What we already posted from Drive, per channel. Sync mode only re-uploads
+# files whose md5/size (or modifiedTime for files without md5) changed.
+_manifest = None
+
+def manifest_db():
+    global _manifest
+    if _manifest is None:
+        _manifest = sqlite3.connect(MANIFEST_DB, check_same_thread=False)
+        _manifest.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "drive_id TEXT, chat_id TEXT, name TEXT, md5 TEXT, size INTEGER, modified_time TEXT, "
+            "parent_path TEXT, message_ids TEXT, synced_at REAL, PRIMARY KEY (drive_id, chat_id))"
         )
-        if os.path.exists(thumb_path): return thumb_path
-    except: pass
+        _manifest.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job_id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, chat_id INTEGER, items TEXT, "
+            "skip_list TEXT, sync INTEGER, status TEXT, created_at REAL)"
+        )
+        _manifest.execute(
+            "CREATE TABLE IF NOT EXISTS journal ("
+            "job_id INTEGER, kind TEXT, key TEXT, value TEXT, PRIMARY KEY (job_id, kind, key))"
+        )
+        _manifest.execute(
+            "CREATE TABLE IF NOT EXISTS probes (md5 TEXT PRIMARY KEY, width INTEGER, height INTEGER, duration INTEGER, thumb TEXT)"
+        )
+        # Content already on Telegram: Drive md5/size (+ part, 0 = unsplit) -> file_id and one message holding it.
+        # Part -1 marks the content complete; its message_id is the number of parts.
+        _manifest.execute(
+            "CREATE TABLE IF NOT EXISTS uploads ("
+            "md5 TEXT, size INTEGER, part INTEGER, file_id TEXT, chat_id TEXT, message_id INTEGER, PRIMARY KEY (md5, size, part))"
+        )
+        # Last integrity check of each Drive file: verified / mismatch / unchecked (no md5 to compare)
+        _manifest.execute(
+            "CREATE TABLE IF NOT EXISTS checksums (drive_id TEXT PRIMARY KEY, md5 TEXT, size INTEGER, status TEXT, checked_at REAL)"
+        )
+        _manifest.commit()
+    return _manifest
+
+def manifest_is_current(item, chat_id):
+    row = manifest_db().execute(
+        "SELECT md5, size, modified_time FROM files WHERE drive_id = ? AND chat_id = ?", (item['id'], str(chat_id))
+    ).fetchone()
+    if not row: return False
+    md5, size, modified_time = row
+    if item.get('md5Checksum'): return md5 == item['md5Checksum'] and size == int(item.get('size', 0))
+    return modified_time == item.get('modifiedTime')
+
+def manifest_record(item, chat_id, parent_path, message_ids):
+    with manifest_db() as db:
+        db.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (item['id'], str(chat_id), item['name'], item.get('md5Checksum'), int(item.get('size', 0)),
+             item.get('modifiedTime'), parent_path, json.dumps(message_ids), time.time())
+        )
+
+def checksum_status(item, md5, size):
+    if not item.get('md5Checksum') or md5 is None: return 'unchecked'
+    if md5 != item['md5Checksum'] or size != int(item.get('size') or 0): return 'mismatch'
+    return 'verified'
+
+def checksum_record(item, status):
+    with manifest_db() as db:
+        db.execute(
+            "INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?)",
+            (item['id'], item.get('md5Checksum'), int(item.get('size') or 0), status, time.time())
+        )
+
+def dedup_lookup(item):
+    # {part: (file_id, chat_id, message_id)} if every part of this content was uploaded before
+    if not item.get('md5Checksum'): return None
+    size = int(item.get('size') or 0)
+    rows = manifest_db().execute(
+        "SELECT part, file_id, chat_id, message_id FROM uploads WHERE md5 = ? AND size = ?", (item['md5Checksum'], size)
+    ).fetchall()
+    known = {row[0]: row[1:] for row in rows}
+    if -1 not in known: return None
+    # Byte parts and video segments differ in count, so the seal says how many there are
+    count = known[-1][2]
+    needed = [0] if count == 1 and 0 in known else range(1, count + 1)
+    if all(part in known for part in needed): return {part: known[part] for part in needed}
     return None
 
+def dedup_record(item, part_num, message):
+    if not item or not item.get('md5Checksum') or not message.media: return
+    file_id = getattr(message, message.media.value).file_id
+    with manifest_db() as db:
+        db.execute(
+            "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?)",
+            (item['md5Checksum'], int(item.get('size') or 0), part_num or 0, file_id, str(message.chat.id), message.id)
+        )
+
+def dedup_seal(item, count):
+    if not item.get('md5Checksum'): return
+    with manifest_db() as db:
+        db.execute("INSERT OR REPLACE INTO uploads VALUES (?, ?, -1, '', '', ?)", (item['md5Checksum'], int(item.get('size') or 0), count))
+
+def dedup_forget(item):
+    with manifest_db() as db:
+        db.execute("DELETE FROM uploads WHERE md5 = ? AND size = ?", (item['md5Checksum'], int(item.get('size') or 0)))
+
+# --- JOB JOURNAL ---
+# Durable checkpoints for a running job, so a restart picks up where it left off:
+#   file   -> drive_id of every fully uploaded file
+#   part   -> "drive_id:part_num" of every uploaded split part (value = message id)
+#   folder -> drive_id of every folder whose whole subtree is done (never listed again)
+#   header -> drive_id of every folder header already posted (value = index line)
+class JobJournal:
+    def __init__(self, job_id, user_id, chat_id, items, skip_list, sync, status):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.items = items
+        self.skip_list = skip_list
+        self.sync = sync
+        self.status = status
+        self.marks = {}
+        rows = manifest_db().execute(
+            "SELECT kind, key, value FROM journal WHERE job_id = ? ORDER BY rowid", (job_id,)
+        ).fetchall()
+        for kind, key, value in rows: self.marks[(kind, key)] = value
+
+    @classmethod
+    def create(cls, user_id, chat_id, items, skip_list, sync):
+        with manifest_db() as db:
+            cur = db.execute(
+                "INSERT INTO jobs (user_id, chat_id, items, skip_list, sync, status, created_at) VALUES (?, ?, ?, ?, ?, 'running', ?)",
+                (user_id, chat_id, json.dumps(items), json.dumps(skip_list), int(sync), time.time())
+            )
+        return cls(cur.lastrowid, user_id, chat_id, items, skip_list, sync, 'running')
+
+    @classmethod
+    def load(cls, job_id):
+        row = manifest_db().execute(
+            "SELECT job_id, user_id, chat_id, items, skip_list, sync, status FROM jobs WHERE job_id = ?", (job_id,)
+        ).fetchone()
+        if not row: return None
+        return cls(row[0], row[1], row[2], json.loads(row[3]), json.loads(row[4]), bool(row[5]), row[6])
+
+    @classmethod
+    def unfinished(cls, status='running', user_id=None):
+        query = "SELECT job_id FROM jobs WHERE status = ?"
+        args = (status,)
+        if user_id is not None:
+            query += " AND user_id = ?"
+            args += (user_id,)
+        return [cls.load(r[0]) for r in manifest_db().execute(query + " ORDER BY job_id", args).fetchall()]
+
+    def done(self, kind, key): return (kind, str(key)) in self.marks
+    def value(self, kind, key): return self.marks.get((kind, str(key)))
+    def values(self, kind): return [v for (k, _), v in self.marks.items() if k == kind]
+
+    def mark(self, kind, key, value=""):
+        self.marks[(kind, str(key))] = str(value)
+        with manifest_db() as db:
+            db.execute("INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?)", (self.job_id, kind, str(key), str(value)))
+
+    def unmark(self, kind, key):
+        self.marks.pop((kind, str(key)), None)
+        with manifest_db() as db:
+            db.execute("DELETE FROM journal WHERE job_id = ? AND kind = ? AND key = ?", (self.job_id, kind, str(key)))
+
+    def set_status(self, status):
+        self.status = status
+        with manifest_db() as db:
+            db.execute("UPDATE jobs SET status = ? WHERE job_id = ?", (status, self.job_id))
+            if status == 'done': db.execute("DELETE FROM journal WHERE job_id = ?", (self.job_id,))
+
+# --- JOB SCHEDULER ---
+# Every job carries its own state, so jobs from different users (or several links
+# from one user) run side by side instead of sharing module globals.
+class Job:
+    def __init__(self, journal, message):
+        self.journal = journal
+        self.job_id = journal.job_id
+        self.user_id = journal.user_id
+        self.chat_id = journal.chat_id
+        self.skip_list = journal.skip_list
+        self.folder_index = [line for line in journal.values('header') if line]
+        self.message = message # Status message that per-file messages reply to
+        self.pipeline = None
+        self.state = 'queued'
+        self.stopped = False
+        self.resumed = asyncio.Event()
+        self.resumed.set()
+
+    def stop(self):
+        self.stopped = True
+        self.resumed.set()
+
+    def pause(self):
+        self.state = 'paused'
+        self.resumed.clear()
+
+    def unpause(self):
+        self.state = 'running'
+        self.resumed.set()
+
+    async def wait_if_paused(self):
+        await self.resumed.wait()
+
+class FairShare:
+    # Global cap on concurrent transfers; while several jobs are active each one
+    # may hold at most an equal share, so one huge job can't starve the others.
+    def __init__(self, limit, active_jobs):
+        self.limit = limit
+        self.active_jobs = active_jobs
+        self.used = {}
+        self.changed = asyncio.Condition()
+
+    def share(self):
+        return max(1, math.ceil(self.limit / max(1, self.active_jobs())))
+
+    def available(self, job_id):
+        return sum(self.used.values()) < self.limit and self.used.get(job_id, 0) < self.share()
+
+    async def acquire(self, job_id):
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.available(job_id))
+            self.used[job_id] = self.used.get(job_id, 0) + 1
+
+    async def release(self, job_id):
+        async with self.changed:
+            self.used[job_id] -= 1
+            if not self.used[job_id]: del self.used[job_id]
+            self.changed.notify_all()
+
+    async def wake(self):
+        async with self.changed: self.changed.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, job_id):
+        await self.acquire(job_id)
+        try: yield
+        finally: await self.release(job_id)
+
+class JobScheduler:
+    # Per-user FIFO queues, served round-robin across users
+    def __init__(self, client, max_active=MAX_ACTIVE_JOBS, max_per_user=MAX_JOBS_PER_USER):
+        self.client = client
+        self.max_active = max_active
+        self.max_per_user = max_per_user
+        self.waiting = {}
+        self.turns = []
+        self.active = {}
+        self.tasks = set()
+
+    def jobs(self, user_id=None):
+        jobs = list(self.active.values()) + [j for queue in self.waiting.values() for j in queue]
+        return [j for j in jobs if user_id is None or j.user_id == user_id]
+
+    def get(self, job_id):
+        return next((j for j in self.jobs() if j.job_id == job_id), None)
+
+    def position(self, job):
+        return self.waiting.get(job.user_id, []).index(job) + 1
+
+    def submit(self, job):
+        self.waiting.setdefault(job.user_id, []).append(job)
+        if job.user_id not in self.turns: self.turns.append(job.user_id)
+        self.dispatch()
+
+    def cancel(self, job):
+        # Drop a job that never started
+        queue = self.waiting.get(job.user_id, [])
+        if job in queue: queue.remove(job)
+        if not queue:
+            self.waiting.pop(job.user_id, None)
+            if job.user_id in self.turns: self.turns.remove(job.user_id)
+        job.journal.set_status('stopped')
+
+    def dispatch(self):
+        while len(self.active) < self.max_active:
+            busy = [j.user_id for j in self.active.values()]
+            uid = next((u for u in self.turns if busy.count(u) < self.max_per_user), None)
+            if uid is None: return
+            job = self.waiting[uid].pop(0)
+            self.turns.remove(uid)
+            if self.waiting[uid]: self.turns.append(uid)
+            else: del self.waiting[uid]
+            job.state = 'running'
+            self.active[job.job_id] = job
+            task = asyncio.create_task(self.run(job))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def run(self, job):
+        try: await run_job(self.client, job)
+        except Exception as e: print(f"Job Error: {e}")
+        finally:
+            self.active.pop(job.job_id, None)
+            # A finished job frees its share for the remaining ones
+            await DOWNLOAD_SLOTS.wake()
+            await UPLOAD_SLOTS.wake()
+            self.dispatch()
+
+scheduler = JobScheduler(bot)
+DOWNLOAD_SLOTS = FairShare(MAX_DOWNLOADS, lambda: len(scheduler.active))
+UPLOAD_SLOTS = FairShare(MAX_UPLOADS, lambda: len(scheduler.active))
+
+# --- STATUS MESSAGES ---
+# Every progress/status edit goes through here. Edits are coalesced per message
+# (only the newest text is ever sent), no-op edits are dropped, and each chat has
+# a token bucket so we stay under Telegram's limits. Callers never wait on an
+# edit, so a FloodWait only delays status text, never the transfers themselves.
+class StatusService:
+    def __init__(self, per_minute=STATUS_EDITS_PER_MINUTE, burst=3):
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.pending = {} # chat_id -> {message_id: (message, text)}
+        self.sent = {} # (chat_id, message_id) -> last text on screen
+        self.buckets = {} # chat_id -> (tokens, timestamp)
+        self.blocked_until = {} # chat_id -> FloodWait end
+        self.workers = {}
+
+    def edit(self, message, text):
+        chat_id, key = message.chat.id, (message.chat.id, message.id)
+        queue = self.pending.setdefault(chat_id, {})
+        if self.sent.get(key) == text:
+            queue.pop(message.id, None)
+            return
+        queue[message.id] = (message, text)
+        if chat_id not in self.workers:
+            self.workers[chat_id] = asyncio.create_task(self.worker(chat_id))
+
+    def forget(self, message):
+        self.pending.get(message.chat.id, {}).pop(message.id, None)
+        self.sent.pop((message.chat.id, message.id), None)
+
+    async def delete(self, message):
+        self.forget(message)
+        try: await message.delete()
+        except Exception as e: print(f"Status Delete Error: {e}")
+
+    async def take_token(self, chat_id):
+        while True:
+            now = time.time()
+            wait = self.blocked_until.get(chat_id, 0) - now
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            tokens, stamp = self.buckets.get(chat_id, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+            if tokens >= 1:
+                self.buckets[chat_id] = (tokens - 1, now)
+                return
+            self.buckets[chat_id] = (tokens, now)
+            await asyncio.sleep((1 - tokens) / self.rate)
+
+    async def worker(self, chat_id):
+        try:
+            queue = self.pending[chat_id]
+            while queue:
+                await self.take_token(chat_id)
+                if not queue: break
+                # Oldest waiting message first; newer text for it simply replaced the queued one
+                message_id = next(iter(queue))
+                message, text = queue.pop(message_id)
+                try:
+                    await message.edit(text)
+                    self.sent[(chat_id, message_id)] = text
+                except FloodWait as e:
+                    FLOODWAITS.labels('status').inc()
+                    FLOODWAIT_SECONDS.labels('status').inc(e.value)
+                    self.blocked_until[chat_id] = time.time() + e.value
+                    if message_id not in queue: RETRIES.labels('status').inc()
+                    queue.setdefault(message_id, (message, text))
+                except MessageNotModified:
+                    self.sent[(chat_id, message_id)] = text
+                except Exception as e: print(f"Status Edit Error: {e}")
+        finally:
+            del self.workers[chat_id]
+
+status = StatusService()
+
+# --- HELPER FUNCTIONS ---
+
+# Media probe: dimensions, duration and thumbnail in one async pass (ffprobe and a
+# fast-seek ffmpeg run side by side), at most PROBE_WORKERS files at a time.
+# Results are cached by Drive md5Checksum so retries and re-uploads skip it.
+probe_slots = asyncio.Semaphore(PROBE_WORKERS)
+
+def is_video(name):
+    return name.lower().endswith(VIDEO_EXTENSIONS)
+
+def downloadable(item):
+    # Google-native files and files with downloading disabled answer alt=media with a 403
+    if item['mimeType'].startswith(GOOGLE_APPS_MIME): return False
+    return item.get('capabilities', {}).get('canDownload', True)
+
+async def run_tool(*cmd):
+    process = await asyncio.create_subprocess_exec(*cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    out, _ = await process.communicate()
+    return process.returncode, out
+
+def cached_probe(key):
+    row = manifest_db().execute("SELECT width, height, duration, thumb FROM probes WHERE md5 = ?", (key,)).fetchone()
+    if not row or (row[3] and not os.path.exists(row[3])): return None
+    return {'width': row[0], 'height': row[1], 'duration': row[2], 'thumb': row[3], 'cached': True}
+
+async def probe_media(path, key=None):
+    if key:
+        media = cached_probe(key)
+        if media: return media
+        os.makedirs(PROBE_CACHE_DIR, exist_ok=True)
+    thumb_path = os.path.join(PROBE_CACHE_DIR, f"{key}.jpg") if key else f"{path}.jpg"
+
+    out, probe_code, thumb_code = b"", 1, 1
+    async with probe_slots:
+        with STAGE_SECONDS.labels('probe').time():
+            try:
+                (probe_code, out), (thumb_code, _) = await asyncio.gather(
+                    run_tool("ffprobe", "-v", "error", "-select_streams", "v:0",
+                             "-show_entries", "stream=width,height,duration:format=duration", "-of", "json", path),
+                    # -ss before -i seeks on the container index instead of decoding from the start
+                    run_tool("ffmpeg", "-v", "error", "-y", "-ss", "2", "-i", path, "-frames:v", "1", thumb_path),
+                )
+            except OSError as e: print(f"Probe Error: {e}")
+
+    width, height, duration = 0, 0, 0
+    try:
+        info = json.loads(out or b"{}")
+        stream = (info.get('streams') or [{}])[0]
+        width, height = int(stream.get('width', 0)), int(stream.get('height', 0))
+        duration = int(float(stream.get('duration') or info.get('format', {}).get('duration') or 0))
+    except (ValueError, TypeError): pass
+    thumb = thumb_path if thumb_code == 0 and os.path.exists(thumb_path) else None
+
+    # Only a complete result is cached; a failed run is simply probed again next time
+    cached = bool(key and probe_code == 0 and width and height and thumb)
+    if cached:
+        with manifest_db() as db:
+            db.execute("INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?)", (key, width, height, duration, thumb))
+    return {'width': width, 'height': height, 'duration': duration, 'thumb': thumb, 'cached': cached}
+
 def natural_sort_key(s):
     return [int(text) if text.isdigit() else text.lower() for text in re.split(r'(\d+)', s)]
 
@@ -88,6 +571,14 @@ def humanbytes(size):
     while size > power: size /= power; n += 1
     return str(round(size, 2)) + " " + Dic_powerN[n] + 'B'
 
+def text_chunks(text, limit=4000):
+    # Telegram caps a message at 4096 characters: split on line breaks
+    chunks = [""]
+    for line in text.split("\n"):
+        if chunks[-1] and len(chunks[-1]) + len(line) + 1 > limit: chunks.append("")
+        chunks[-1] += (line if not chunks[-1] else "\n" + line)[:limit]
+    return chunks
+
 def time_formatter(milliseconds: int) -> str:
     seconds, milliseconds = divmod(int(milliseconds), 1000)
     minutes, seconds = divmod(seconds, 60)
@@ -98,50 +589,246 @@ def time_formatter(milliseconds: int) -> str:
         ((str(minutes) + "m, ") if minutes else "") + \
         ((str(seconds) + "s, ") if seconds else "")
 
-async def progress(current, total, message, start_time, status_text):
-    now = time.time()
-    diff = now - start_time
-    if round(diff % 5.00) == 0 or current == total:
-        percentage = current * 100 / total
-        speed = current / diff
-        if speed == 0: speed = 1 
-        time_to_completion = round((total - current) / speed) * 1000
-        
-        filled_length = int(10 * percentage // 100)
-        bar = '▰' * filled_length + '▱' * (10 - filled_length)
-        
-        tmp = (
-            f"{status_text}\n\n"
-            f"**{bar}** {round(percentage, 1)}%\n"
-            f"📦 **Size:** {humanbytes(current)} / {humanbytes(total)}\n"
-            f"🚀 **Speed:** {humanbytes(speed)}/s\n"
-            f"⏱ **ETA:** {time_formatter(time_to_completion)}"
-        )
-        try: await message.edit(tmp)
-        except: pass
+async def progress(current, total, message, start_time, status_text, counted=None):
+    # Called for every uploaded chunk; StatusService decides what actually gets sent
+    if counted is not None:
+        # counted: [bytes of this upload already added to UPLOADED_BYTES]
+        UPLOADED_BYTES.inc(max(current - counted[0], 0))
+        counted[0] = max(current, counted[0])
+    diff = max(time.time() - start_time, 0.001)
+    percentage = current * 100 / total
+    speed = current / diff
+    if speed == 0: speed = 1 
+    time_to_completion = round((total - current) / speed) * 1000
+    
+    filled_length = int(10 * percentage // 100)
+    bar = '▰' * filled_length + '▱' * (10 - filled_length)
+    
+    tmp = (
+        f"{status_text}\n\n"
+        f"**{bar}** {round(percentage, 1)}%\n"
+        f"📦 **Size:** {humanbytes(current)} / {humanbytes(total)}\n"
+        f"🚀 **Speed:** {humanbytes(speed)}/s\n"
+        f"⏱ **ETA:** {time_formatter(time_to_completion)}"
+    )
+    status.edit(message, tmp)
 
-async def count_total_files(service, folder_id):
-    total = 0
-    query = f"'{folder_id}' in parents and trashed = false"
-    page_token = None
-    while True:
-        results = await asyncio.to_thread(
-            service.files().list(q=query, fields="nextPageToken, files(id, mimeType)", pageToken=page_token).execute
-        )
-        items = results.get('files', [])
-        for item in items:
-            if item['mimeType'] == 'application/vnd.google-apps.folder':
-                total += await count_total_files(service, item['id']) 
-            else:
-                total += 1
-        page_token = results.get('nextPageToken')
-        if not page_token: break
-    return total
+# --- SERVICE ACCOUNT POOL ---
+# Drive's download quota and rate limits are per account. Downloads go to the least used
+# account, and one that hits a quota or rate limit rests while the others carry on.
+QUOTA_REASONS = ('downloadQuotaExceeded', 'quotaExceeded', 'dailyLimitExceeded')
+RATE_REASONS = ('userRateLimitExceeded', 'rateLimitExceeded')
+
+class DriveLimitError(Exception):
+    def __init__(self, message, cooldown=QUOTA_COOLDOWN):
+        super().__init__(message)
+        self.cooldown = cooldown
+
+def drive_limit(http_status, body):
+    # The DriveLimitError for a quota/rate limit response, else None
+    if http_status not in (403, 429): return None
+    try: errors = json.loads(body)['error'].get('errors', [])
+    except (ValueError, KeyError, TypeError, AttributeError): errors = []
+    reasons = [e.get('reason') for e in errors]
+    if any(r in QUOTA_REASONS for r in reasons): return DriveLimitError("Drive download quota exceeded", QUOTA_COOLDOWN)
+    if http_status == 429 or any(r in RATE_REASONS for r in reasons): return DriveLimitError("Drive rate limit exceeded", RATE_COOLDOWN)
+    return None
+
+class ServiceAccount:
+    def __init__(self, name, creds):
+        self.name = name
+        self.creds = creds
+        self.files = 0
+        self.bytes = 0
+        self.limits = 0
+        self.resting_until = 0
+        self.refreshing = asyncio.Lock()
+
+    def expiring(self):
+        if not self.creds.token: return True
+        if not self.creds.expiry: return False
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) # google-auth uses naive UTC
+        return self.creds.expiry - now < datetime.timedelta(seconds=TOKEN_MARGIN)
 
-# --- GOOGLE DRIVE FUNCTIONS ---
-def get_gdrive_service():
-    creds = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-    return build('drive', 'v3', credentials=creds), creds
+    async def token(self):
+        # Normally already fresh (AccountPool.keep_fresh); otherwise refreshed off the event loop, once
+        if self.expiring():
+            async with self.refreshing:
+                if self.expiring(): await asyncio.to_thread(self.creds.refresh, google.auth.transport.requests.Request())
+        return self.creds.token
+
+class AccountPool:
+    def __init__(self, main_file, directory):
+        self.main_file = main_file
+        self.directory = directory
+        self.accounts = None
+        self.day = None
+
+    def load(self):
+        if self.accounts is not None: return
+        paths = [self.main_file] if os.path.exists(self.main_file) else []
+        if os.path.isdir(self.directory):
+            paths += sorted(os.path.join(self.directory, f) for f in os.listdir(self.directory) if f.endswith('.json'))
+        if not paths: raise FileNotFoundError(f"No service account: {self.main_file} / {self.directory}/*.json")
+        self.accounts = [ServiceAccount(os.path.splitext(os.path.basename(p))[0], service_account.Credentials.from_service_account_file(p, scopes=SCOPES))
+                         for p in paths]
+
+    def roll_day(self):
+        # Usage is shown per UTC day, like Drive's quota
+        today = time.strftime("%Y-%m-%d", time.gmtime())
+        if self.day == today: return
+        self.day = today
+        for account in self.accounts: account.files, account.bytes = 0, 0
+
+    def pick(self):
+        self.load()
+        self.roll_day()
+        now = time.time()
+        ready = [a for a in self.accounts if a.resting_until <= now]
+        if not ready:
+            soonest = min(a.resting_until for a in self.accounts)
+            raise DriveLimitError(f"All {len(self.accounts)} service accounts are over Drive's limits, next one back in {time_formatter((soonest - now) * 1000)}")
+        return min(ready, key=lambda a: (a.bytes, a.files))
+
+    def owner(self, creds):
+        self.load()
+        return next((a for a in self.accounts if a.creds is creds), None)
+
+    def resting(self, creds):
+        account = self.owner(creds)
+        return bool(account and account.resting_until > time.time())
+
+    def rest(self, creds, error):
+        account = self.owner(creds)
+        if not account: return
+        account.limits += 1
+        account.resting_until = max(account.resting_until, time.time() + error.cooldown)
+        DRIVE_LIMITS.labels(account.name).inc()
+        print(f"Drive Limit: {account.name} resting {error.cooldown}s ({error})")
+
+    def record(self, creds, size):
+        account = self.owner(creds)
+        if not account: return
+        self.roll_day()
+        account.files += 1
+        account.bytes += size
+        DRIVE_ACCOUNT_BYTES.labels(account.name).inc(size)
+
+    async def token(self, creds):
+        account = self.owner(creds)
+        if account: return await account.token()
+        if not creds.valid: await asyncio.to_thread(creds.refresh, google.auth.transport.requests.Request())
+        return creds.token
+
+    async def keep_fresh(self, interval=60):
+        # Tokens of accounts in use are renewed before they run out, so no download waits on auth
+        while True:
+            try:
+                self.load()
+                for account in self.accounts:
+                    if account.creds.token and account.expiring(): await account.token()
+            except Exception as e: print(f"Token Refresh Error: {e}")
+            await asyncio.sleep(interval)
+
+    def usage(self):
+        self.load()
+        self.roll_day()
+        now = time.time()
+        lines = []
+        for a in self.accounts:
+            state = f"😴 resting {time_formatter((a.resting_until - now) * 1000)}" if a.resting_until > now else "✅ ready"
+            lines.append(f"`{a.name}`: {a.files} files, {humanbytes(a.bytes) or '0 B'}, {a.limits} limits - {state}")
+        return lines
+
+accounts = AccountPool(SERVICE_ACCOUNT_FILE, SERVICE_ACCOUNTS_DIR)
+
+# --- DRIVE API ---
+# files.list / files.get / media reads straight on aiohttp: one keep-alive connection pool
+# for the whole bot, tokens from the account pool, backoff on 5xx and network errors.
+class DriveError(Exception):
+    def __init__(self, http_status, body):
+        try: reason = json.loads(body)['error']['message']
+        except (ValueError, KeyError, TypeError): reason = body[:200]
+        super().__init__(f"Drive API Error {http_status}: {reason}")
+        self.status = http_status
+
+class DriveClient:
+    def __init__(self, base_url=DRIVE_API_URL, connections=DRIVE_CONNECTIONS, retries=DRIVE_RETRIES):
+        self.base_url = base_url
+        self.connections = connections
+        self.retries = retries
+        self.session = None
+
+    def open(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.connections, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(sock_connect=30, sock_read=60)
+            )
+        return self.session
+
+    async def close(self):
+        if self.session: await self.session.close()
+
+    async def call(self, path, params, creds=None):
+        # One JSON request. creds=None: the pool picks; a limited account is swapped for another
+        attempt, switches = 0, 0
+        while True:
+            if creds is None or accounts.resting(creds): creds = accounts.pick().creds
+            try:
+                headers = {"Authorization": f"Bearer {await accounts.token(creds)}"}
+                async with self.open().get(f"{self.base_url}/{path}", params=params, headers=headers) as resp:
+                    if resp.status == 200: return await resp.json(content_type=None)
+                    body = await resp.text()
+                limit = drive_limit(resp.status, body)
+                if limit:
+                    accounts.rest(creds, limit)
+                    switches += 1
+                    if switches > ACCOUNT_SWITCHES: raise limit
+                    RETRIES.labels('drive').inc()
+                    creds = None
+                    continue
+                error = DriveError(resp.status, body)
+                if resp.status == 401: creds.token = None # Rejected token: fetch a new one
+                elif resp.status < 500: raise error
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e: error = e
+            if attempt >= self.retries: raise error
+            RETRIES.labels('drive').inc()
+            await asyncio.sleep(min(32, 2 ** attempt) + random.random())
+            attempt += 1
+
+    async def list(self, query, fields=DRIVE_LIST_FIELDS, creds=None):
+        items, page_token = [], None
+        while True:
+            params = {"q": query, "fields": fields, "pageSize": 1000}
+            if page_token: params["pageToken"] = page_token
+            page = await self.call("files", params, creds)
+            items.extend(page.get('files', []))
+            page_token = page.get('nextPageToken')
+            if not page_token: return items
+
+    async def get(self, file_id, fields=DRIVE_FILE_FIELDS, creds=None):
+        return await self.call(f"files/{file_id}", {"fields": fields}, creds)
+
+    async def limit_for(self, file_id, creds):
+        # The DriveLimitError behind a failed download (e.g. aria2's bare 403), else None
+        try:
+            async with self.media(file_id, creds, 0, 1): return None
+        except DriveLimitError as e: return e
+        except Exception: return None
+
+    @contextlib.asynccontextmanager
+    async def media(self, file_id, creds, offset, end):
+        # The response for bytes [offset, end); a quota/rate limit raises DriveLimitError,
+        # any other error DriveError with its status, for the caller to retry or give up
+        headers = {"Authorization": f"Bearer {await accounts.token(creds)}", "Range": f"bytes={offset}-{end - 1}"}
+        async with self.open().get(f"{self.base_url}/files/{file_id}", params={"alt": "media"}, headers=headers) as resp:
+            if resp.status not in (200, 206):
+                body = await resp.text()
+                raise drive_limit(resp.status, body) or DriveError(resp.status, body)
+            yield resp
+
+drive = DriveClient()
 
 def get_file_id_from_url(url):
     if "id=" in url: return url.split("id=")[1].split("&")[0]
@@ -149,63 +836,344 @@ def get_file_id_from_url(url):
     elif "/d/" in url: return url.split("/d/")[1].split("/")[0]
     return url
 
+# --- DRIVE TREE WALKER ---
+async def list_children(folder_id):
+    with STAGE_SECONDS.labels('list').time():
+        items = await drive.list(f"'{folder_id}' in parents and trashed = false")
+    items.sort(key=lambda x: natural_sort_key(x['name']))
+    return items
+
+async def walk_drive_tree(folder_id, prune=None, concurrency=WALK_CONCURRENCY, cache=None):
+    # Yields (parent_path, depth, item) depth-first in natural order. As soon as a folder is
+    # listed, its sub-folders are queued for listing (at most `concurrency` at a time), so
+    # the tree is fetched ahead while the caller is still busy with earlier entries.
+    # Folders for which prune(item) is true are yielded but never listed.
+    # cache: {folder_id: items} listings to use (and drop) instead of fetching; new ones are added.
+    limit = asyncio.Semaphore(concurrency)
+    listings = {}
+
+    def expand(fid):
+        if fid not in listings: listings[fid] = asyncio.create_task(fetch(fid))
+
+    async def fetch(fid):
+        if cache is not None and fid in cache: items = cache.pop(fid)
+        else:
+            async with limit:
+                items = await list_children(fid)
+            if cache is not None: cache[fid] = items
+        for item in items:
+            if item['mimeType'] == FOLDER_MIME and not (prune and prune(item)): expand(item['id'])
+        return items
+
+    async def walk(fid, parent_path, depth):
+        items = await listings[fid]
+        for item in items:
+            yield parent_path, depth, item
+            if item['mimeType'] == FOLDER_MIME and item['id'] in listings:
+                async for entry in walk(item['id'], parent_path + item['name'] + " / ", depth + 1):
+                    yield entry
+
+    expand(folder_id)
+    try:
+        async for entry in walk(folder_id, "", 0):
+            yield entry
+    finally:
+        for task in listings.values():
+            if not task.done(): task.cancel()
+
+# --- SCRATCH STORAGE ---
+# Admission control for downloads: a file's Drive-reported size (plus any split
+# overhead) is reserved before its download starts and released once the temp
+# file is deleted. Files that don't fit wait until space is freed.
+class StorageError(Exception):
+    pass
+
+def allocated_bytes(path):
+    try: return os.stat(path).st_blocks * 512
+    except OSError: return 0
+
+class StorageManager:
+    def __init__(self, directory=SCRATCH_DIR, quota=SCRATCH_QUOTA, headroom=DISK_HEADROOM):
+        self.directory = os.path.abspath(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self.quota = quota
+        self.headroom = headroom
+        self.reserved = {} # key -> (size, path)
+        self.changed = asyncio.Condition()
+
+    def path_for(self, key):
+        # key = (job_id, file_id), as reserved: jobs over the same content never share a temp file
+        job_id, file_id = key
+        return os.path.join(self.directory, f"temp_{job_id}_{file_id}")
+
+    def reserve_size(self, item):
+        # Byte-range splitting uploads parts straight from the download, so no extra space
+        if streamable(item): return 0
+        # Video segments sit next to the original until they're uploaded
+        if needs_segments(item): return 2 * int(item['size'])
+        return int(item.get('size') or 0)
+
+    def room(self):
+        used = sum(size for size, _ in self.reserved.values())
+        # Part of each reservation may already be on disk (and gone from "free")
+        written = sum(min(size, allocated_bytes(path)) for size, path in self.reserved.values())
+        room = shutil.disk_usage(self.directory).free - self.headroom - (used - written)
+        if self.quota: room = min(room, self.quota - used)
+        return room
+
+    async def reserve(self, key, size, path, message=None, job=None, wait=True):
+        # False if the job was stopped while waiting; wait=False raises instead of waiting for space
+        async with self.changed:
+            while size and size > self.room():
+                if job and job.stopped: return False
+                if not wait or not self.reserved:
+                    raise StorageError(f"Not enough scratch space: needs {humanbytes(size)}, only {humanbytes(max(self.room(), 0))} available")
+                if message: status.edit(message, f"💾 **Waiting for disk space:** {humanbytes(size)} needed")
+                # Re-check periodically too: space can be freed outside the bot
+                try: await asyncio.wait_for(self.changed.wait(), 5)
+                except asyncio.TimeoutError: pass
+            self.reserved[key] = (size, path)
+            return True
+
+    async def release(self, key):
+        async with self.changed:
+            if self.reserved.pop(key, None): self.changed.notify_all()
+
+storage = StorageManager()
+
 # --- ARIA2C DOWNLOADER ---
-async def download_with_aria2(file_id, original_name, message, creds):
-    temp_filename = f"temp_{file_id}" 
-    file_path = f"./{temp_filename}"
+# One long-lived aria2c in RPC mode serves every download. Progress comes from
+# tellStatus (exact completed bytes/speed) instead of guessing from a sparse file.
+class Aria2Error(Exception):
+    pass
+
+def aria2_split_for(size):
+    # Small files gain nothing from extra connections; big ones get one per ~64 MiB, up to 16
+    if not size: return 4
+    return max(1, min(16, int(size) // (64 * 1024 * 1024) + 1))
+
+class Aria2Engine:
+    def __init__(self, rpc_url=ARIA2_RPC_URL, secret=ARIA2_RPC_SECRET, spawn=ARIA2_SPAWN):
+        self.rpc_url = rpc_url
+        self.secret = secret
+        self.spawn = spawn
+        self.process = None
+        self.session = None
+        self.started = None
+
+    async def start(self):
+        if self.started is None: self.started = asyncio.ensure_future(self._start())
+        await self.started
+
+    async def _start(self):
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+        if self.spawn:
+            port = self.rpc_url.split(":")[-1].split("/")[0]
+            self.process = await asyncio.create_subprocess_exec(
+                "aria2c", "--enable-rpc", f"--rpc-listen-port={port}", f"--rpc-secret={self.secret}",
+                f"--max-concurrent-downloads={MAX_DOWNLOADS}", "--continue=true", "--file-allocation=falloc",
+                # A piece aria2 reports done must already be in the file for PrefixHasher to read it
+                "--disk-cache=0",
+                "--connect-timeout=60", "--max-tries=5", "--retry-wait=3",
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+        for _ in range(50):
+            try: return await self.call("getVersion")
+            except (aiohttp.ClientError, OSError): await asyncio.sleep(0.2)
+        raise Aria2Error("aria2 RPC did not come up")
+
+    async def stop(self):
+        if self.process and self.process.returncode is None:
+            try: await self.call("shutdown")
+            except Exception: self.process.terminate()
+            await self.process.wait()
+        if self.session: await self.session.close()
+
+    async def call(self, method, *params):
+        payload = {"jsonrpc": "2.0", "id": "bot", "method": f"aria2.{method}", "params": [f"token:{self.secret}", *params]}
+        async with self.session.post(self.rpc_url, json=payload) as resp:
+            data = await resp.json(content_type=None)
+        if "error" in data: raise Aria2Error(data["error"].get("message", "aria2 RPC error"))
+        return data["result"]
+
+    async def alive(self):
+        try:
+            await self.call("getVersion")
+            return True
+        except Exception: return False
+
+    async def add(self, url, directory, out, headers, size=None):
+        split = aria2_split_for(size)
+        options = {
+            "dir": directory, "out": out, "header": headers,
+            "split": str(split), "max-connection-per-server": str(split), "min-split-size": "1M",
+            # All connections take the lowest free pieces, so the finished prefix (PrefixHasher) keeps up
+            "stream-piece-selector": "inorder",
+            "continue": "true", "allow-overwrite": "true", # Resume a partial temp file left behind by a crash
+        }
+        return await self.call("addUri", [url], options)
+
+    async def status(self, gid):
+        return await self.call("tellStatus", gid, ["status", "totalLength", "completedLength", "downloadSpeed", "errorCode", "errorMessage", "bitfield", "pieceLength"])
+
+    async def set_headers(self, gid, headers):
+        # aria2 restarts a running download with the new options, resuming from its control file
+        return await self.call("changeOption", gid, {"header": headers})
+
+    async def remove(self, gid):
+        try: await self.call("forceRemove", gid)
+        except Aria2Error: pass
+        try: await self.call("removeDownloadResult", gid)
+        except Aria2Error: pass
+
+aria2 = Aria2Engine()
+
+class PrefixHasher:
+    # md5 of a file aria2 writes in parallel: the contiguous run of finished pieces from the
+    # start is hashed while the rest is still downloading (in-order piece selection keeps that
+    # run close behind the connections). What's left at the end shows up in VERIFY_TAIL_BYTES.
+    def __init__(self, path):
+        self.path = path
+        self.md5 = hashlib.md5()
+        self.offset = 0
+        self.task = None
+
+    def prefix(self, state):
+        bitfield, piece = state.get("bitfield"), int(state.get("pieceLength") or 0)
+        if not bitfield or not piece: return 0
+        bits = bin(int(bitfield, 16))[2:].zfill(len(bitfield) * 4)
+        return min((len(bits) - len(bits.lstrip("1"))) * piece, int(state["totalLength"]))
+
+    def read_to(self, end):
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            while self.offset < end:
+                data = f.read(min(1024 * 1024, end - self.offset))
+                if not data: break
+                self.md5.update(data)
+                self.offset += len(data)
+
+    def advance(self, state):
+        # One background read at a time; the watcher never waits for it
+        end = self.prefix(state)
+        if end > self.offset and (self.task is None or self.task.done()):
+            self.task = asyncio.ensure_future(asyncio.to_thread(self.read_to, end))
+
+    async def finish(self):
+        if self.task: await self.task
+        size = os.path.getsize(self.path)
+        VERIFY_TAIL_BYTES.inc(max(size - self.offset, 0))
+        await asyncio.to_thread(self.read_to, size)
+        return self.md5.hexdigest(), self.offset
+
+async def download_with_aria2(file_id, original_name, message, creds, job, size=None, hasher=None):
+    file_path = storage.path_for((job.job_id, file_id))
     
-    request = google.auth.transport.requests.Request()
-    creds.refresh(request)
-    token = creds.token
-    download_url = f"https://www.googleapis.com/drive/v3/files/{file_id}?alt=media"
+    token = await accounts.token(creds)
+    download_url = f"{DRIVE_API_URL}/files/{file_id}?alt=media"
     
-    start_time = time.time()
-    await message.edit(f"⬇️ **Starting Download...**\n`{original_name}`")
-
-    cmd = [
-        "aria2c", 
-        f"--header=Authorization: Bearer {token}",
-        "-x8", "-s8", "-j8", "-k1M", 
-        "--connect-timeout=60",      
-        "--max-tries=5", 
-        "--retry-wait=3",
-        "--out", temp_filename,
-        download_url
-    ]
+    await aria2.start()
+    status.edit(message, f"⬇️ **Starting Download...**\n`{original_name}`")
+    gid = await aria2.add(download_url, storage.directory, os.path.basename(file_path), [f"Authorization: Bearer {token}"], size)
 
-    process = await asyncio.create_subprocess_exec(
-        *cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-    )
-    
-    last_update_time = 0
-    while process.returncode is None:
-        if STOP_PROCESS:
-            process.terminate()
-            raise Exception("Stopped by User")
-        
-        if os.path.exists(file_path):
-            current_size = os.path.getsize(file_path)
-            now = time.time()
-            if current_size > 0 and (now - last_update_time) > 4: 
-                last_update_time = now
-                try:
-                    speed = current_size / (now - start_time)
-                    await message.edit(
-                        f"⬇️ **Downloading:**\n`{original_name}`\n\n"
-                        f"📦 **Downloaded:** {humanbytes(current_size)}\n"
-                        f"🚀 **Speed:** {humanbytes(speed)}/s"
-                    )
-                except: pass
-        
-        await asyncio.sleep(2)
-        if process.returncode is not None: break
+    try:
+        state = await watch_aria2(gid, original_name, message, job, hasher, creds, token)
+    except BaseException:
+        if hasher and hasher.task: hasher.task.cancel()
+        # Stop / cancelled by the pipeline: don't leave the download or a partial file behind
+        await aria2.remove(gid)
+        for path in (file_path, f"{file_path}.aria2"):
+            if os.path.exists(path): os.remove(path)
+        raise
 
-    await process.wait()
-    if process.returncode != 0: raise Exception("Download Failed (Network/Space)")
+    await aria2.remove(gid)
+    if state["status"] != "complete":
+        reason = state.get('errorMessage') or state['status']
+        # aria2 exit/error code 9: not enough disk space
+        if state.get("errorCode") == "9": raise StorageError(f"Download Failed (Disk Full): {reason}")
+        # aria2 only reports the HTTP status. A 429 is always a rate limit, but a 403 is also
+        # "this file can't be downloaded", so Drive is asked for the reason before resting the account
+        if "status=429" in reason: raise DriveLimitError(f"Download Failed (Rate Limit): {reason}", RATE_COOLDOWN)
+        if "status=403" in reason:
+            limit = await drive.limit_for(file_id, creds)
+            if limit: raise limit
+            raise Exception(f"Download Failed (Forbidden): {reason}")
+        raise Exception(f"Download Failed (Network): {reason}")
     return file_path
 
+async def watch_aria2(gid, original_name, message, job, hasher=None, creds=None, token=None):
+    counted = 0 # Bytes already added to DOWNLOADED_BYTES
+    while True:
+        if job.stopped: raise Exception("Stopped by User")
+        if creds:
+            # Downloads can outlive the hour a token is good for: hand aria2 the renewed one
+            fresh = await accounts.token(creds)
+            if fresh != token:
+                try:
+                    await aria2.set_headers(gid, [f"Authorization: Bearer {fresh}"])
+                    token = fresh
+                except Aria2Error as e: print(f"Aria2 Token Error: {e}")
+        state = await aria2.status(gid)
+        done = int(state["completedLength"])
+        if done > counted:
+            DOWNLOADED_BYTES.inc(done - counted)
+            counted = done
+        if hasher: hasher.advance(state)
+        if state["status"] in ("complete", "error", "removed"): return state
+        
+        total, speed = int(state["totalLength"]), int(state["downloadSpeed"])
+        if done > 0: 
+            eta = time_formatter((total - done) / speed * 1000) if speed and total else "-"
+            status.edit(message,
+                f"⬇️ **Downloading:**\n`{original_name}`\n\n"
+                f"📦 **Downloaded:** {humanbytes(done)} / {humanbytes(total)}\n"
+                f"🚀 **Speed:** {humanbytes(speed)}/s\n"
+                f"⏱ **ETA:** {eta}"
+            )
+        
+        await asyncio.sleep(1)
+
 # --- UPLOAD ---
-async def upload_file(client, file_path, display_name, chat_id, caption, message, is_part=False):
+class FileSlice(io.RawIOBase):
+    # Read-only (offset, length) window over a file, so a part can be uploaded
+    # straight from the original download without copying it to RAM or disk.
+    def __init__(self, path, offset, length, name):
+        super().__init__()
+        self.f = open(path, 'rb')
+        self.offset = offset
+        self.length = length
+        self.pos = 0
+        self.name = name
+
+    def readable(self): return True
+    def seekable(self): return True
+    def tell(self): return self.pos
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR: pos += self.pos
+        elif whence == os.SEEK_END: pos += self.length
+        self.pos = min(max(pos, 0), self.length)
+        return self.pos
+
+    def read(self, size=-1):
+        remaining = self.length - self.pos
+        if size is None or size < 0 or size > remaining: size = remaining
+        if size <= 0: return b""
+        self.f.seek(self.offset + self.pos)
+        data = self.f.read(size)
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+def upload_source(file_path, display_name, byte_range):
+    # A fresh view per attempt; Pyrogram only closes files it opened itself, so callers close these
+    if byte_range is None: return file_path
+    return FileSlice(file_path, byte_range[0], byte_range[1], display_name)
+
+async def upload_file(client, file_path, display_name, chat_id, caption, message, is_part=False, byte_range=None, media=None):
     start_time = time.time()
     status_text = f"⬆️ **Uploading:**\n`{display_name}`"
     if is_part: status_text = f"⬆️ **Uploading Part:**\n`{display_name}`"
@@ -213,128 +1181,1031 @@ async def upload_file(client, file_path, display_name, chat_id, caption, message
     thumb_path = None
     width, height, duration = 0, 0, 0
 
-    if display_name.lower().endswith(('.mp4', '.mkv', '.avi', '.mov', '.webm')) and not is_part:
-        status_text = f"⚙️ **Processing Video:**\n`{display_name}`"
-        try:
-            await message.edit(status_text)
-            thumb_path = await generate_thumbnail(file_path)
-            width, height, duration = get_video_attributes(file_path)
-        except: pass
-        status_text = f"⬆️ **Uploading:**\n`{display_name}`"
+    if is_video(display_name) and not is_part:
+        # Normally probed by the pipeline while the file waited for its turn
+        if media is None:
+            status.edit(message, f"⚙️ **Processing Video:**\n`{display_name}`")
+            media = await probe_media(file_path)
+        thumb_path, width, height, duration = media['thumb'], media['width'], media['height'], media['duration']
+
+    timer = STAGE_SECONDS.labels('upload').time()
+    sources = []
+
+    def source():
+        sources.append(upload_source(file_path, display_name, byte_range))
+        return sources[-1]
 
     try:
-        if display_name.lower().endswith(('.mp4', '.mkv', '.avi', '.mov', '.webm')):
-             await client.send_video(
-                chat_id, video=file_path, caption=caption, file_name=display_name,
-                thumb=thumb_path, width=width, height=height, duration=duration,
-                progress=progress, progress_args=(message, start_time, status_text),
-                supports_streaming=True
-            )
-        else:
-            await client.send_document(
-                chat_id, document=file_path, caption=caption, file_name=display_name,
-                progress=progress, progress_args=(message, start_time, status_text)
-            )
+        with timer:
+            if is_video(display_name):
+                return await client.send_video(
+                    chat_id, video=source(), caption=caption, file_name=display_name,
+                    thumb=thumb_path, width=width, height=height, duration=duration,
+                    progress=progress, progress_args=(message, start_time, status_text, [0]),
+                    supports_streaming=True
+                )
+            else:
+                return await client.send_document(
+                    chat_id, document=source(), caption=caption, file_name=display_name,
+                    progress=progress, progress_args=(message, start_time, status_text, [0])
+                )
     except Exception as e:
         print(f"Upload Error: {e}")
-        await client.send_document(chat_id, document=file_path, caption=caption, file_name=display_name)
+        if isinstance(e, FloodWait):
+            FLOODWAITS.labels('upload').inc()
+            FLOODWAIT_SECONDS.labels('upload').inc(e.value)
+            await asyncio.sleep(e.value)
+        RETRIES.labels('upload').inc()
+        with timer:
+            return await client.send_document(
+                chat_id, document=source(), caption=caption, file_name=display_name,
+                progress=progress, progress_args=(message, start_time, status_text, [0])
+            )
     finally:
-        if thumb_path and os.path.exists(thumb_path): os.remove(thumb_path)
+        for f in sources:
+            if not isinstance(f, str): f.close()
+        # Cached thumbnails are kept for the next upload of the same content
+        if thumb_path and not media['cached'] and os.path.exists(thumb_path): os.remove(thumb_path)
 
-# --- RECURSIVE CORE ---
-async def recursive_process(client, service, creds, folder_id, user_id, message, parent_path="", is_root_selection=False):
-    global STOP_PROCESS, FOLDER_INDEX, SKIP_UNTIL_NAME, FOUND_START_FILE, GLOBAL_SKIP_LIST
-    if STOP_PROCESS: return
+# --- STREAMING ---
+# STREAM_MODE: non-video files go Drive -> Telegram without touching the disk. Each
+# part is one ranged GET cut into 512 KiB upload chunks; at most STREAM_BUFFER bytes
+# wait in memory, and the first chunk is uploaded while the rest is still coming in.
+# Videos still go through the disk, since ffprobe/ffmpeg need a seekable file.
+STREAM_CHUNK = 512 * 1024 # Telegram upload part size
+STREAM_PARALLEL = 4 # Parts in flight per upload, as in Pyrogram's save_file
 
-    config = load_config()
-    chat_id = config.get("channel_id")
-    
-    query = f"'{folder_id}' in parents and trashed = false"
-    results = await asyncio.to_thread(service.files().list(q=query, fields="nextPageToken, files(id, name, mimeType)").execute)
-    items = results.get('files', [])
+def streamable(item):
+    return STREAM_MODE and int(item.get('size') or 0) > 0 and not is_video(item['name'])
 
-    if not items: return
-    items.sort(key=lambda x: natural_sort_key(x['name']))
+class DriveStream:
+    def __init__(self, item, caption, job):
+        self.creds = None
+        self.item = item
+        self.job = job
+        self.parts = split_plan(int(item['size']), item['name'], caption)
+        self.queue = asyncio.Queue(max(2, STREAM_BUFFER // STREAM_CHUNK))
+        self.task = None
+        # Verified as it flows through, when the whole file goes through this stream
+        self.md5 = None
+        if VERIFY_DOWNLOADS and item.get('md5Checksum') and len(self.pending()) == len(self.parts): self.md5 = hashlib.md5()
+        self.hashed = 0
+
+    def pending(self):
+        return [p for p in self.parts if not (p[0] and self.job.journal.done('part', f"{self.item['id']}:{p[0]}"))]
+
+    def start(self):
+        self.task = asyncio.create_task(self.produce())
+
+    def close(self):
+        if self.task and not self.task.done(): self.task.cancel()
+
+    async def produce(self):
+        # Chunks never cross a part boundary; an error is queued for the consumer to raise.
+        # No DOWNLOAD_SLOTS here: a stream waiting for its turn would hold a slot the
+        # file ahead of it may need. PREFETCH_DEPTH already bounds streams per job.
+        try:
+            self.creds = accounts.pick().creds
+            for _, _, _, byte_range in self.pending():
+                offset, length = byte_range or (0, int(self.item['size']))
+                async for chunk in self.read_range(offset, length):
+                    if self.md5:
+                        self.md5.update(chunk)
+                        self.hashed += len(chunk)
+                    await self.queue.put(chunk)
+            accounts.record(self.creds, int(self.item['size']))
+        except Exception as e: await self.queue.put(e)
+
+    async def read_range(self, offset, length):
+        buffer = bytearray()
+        end = offset + length
+        attempt, switches = 0, 0
+        while attempt < 3:
+            try:
+                async with drive.media(self.item['id'], self.creds, offset, end) as resp:
+                    async for data in resp.content.iter_chunked(64 * 1024):
+                        DOWNLOADED_BYTES.inc(len(data))
+                        offset += len(data)
+                        buffer += data
+                        while len(buffer) >= STREAM_CHUNK:
+                            yield bytes(buffer[:STREAM_CHUNK])
+                            del buffer[:STREAM_CHUNK]
+                if offset >= end: break
+                attempt += 1
+            except DriveLimitError as limit:
+                # Same range again from another account, up to ACCOUNT_SWITCHES of them
+                accounts.rest(self.creds, limit)
+                switches += 1
+                if switches > ACCOUNT_SWITCHES: raise
+                RETRIES.labels('stream').inc()
+                self.creds = accounts.pick().creds
+            except DriveError as e:
+                # Rejected token: fetch a new one. Drive 5xx: back off like a dropped connection
+                if e.status == 401: self.creds.token = None
+                elif e.status < 500: raise
+                print(f"Stream Error: {e}")
+                RETRIES.labels('stream').inc()
+                await asyncio.sleep(2 ** attempt)
+                attempt += 1
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # Carry on from the last byte received
+                print(f"Stream Error: {e}")
+                RETRIES.labels('stream').inc()
+                await asyncio.sleep(2 ** attempt)
+                attempt += 1
+        if offset < end: raise Exception("Download Failed (Network): stream ended early")
+        if buffer: yield bytes(buffer)
+
+    async def next_chunk(self):
+        chunk = await self.queue.get()
+        if isinstance(chunk, Exception): raise chunk
+        return chunk
+
+    async def fetch(self, offset, length):
+        # One chunk again, for a part Telegram reports missing
+        if self.creds is None: self.creds = accounts.pick().creds
+        return b"".join([chunk async for chunk in self.read_range(offset, length)])
 
-    for item in items:
-        if STOP_PROCESS: return
+async def send_uploaded_media(client, chat_id, input_file, file_name, caption, mime_type, thumb=None, media=None):
+    # Posts an already uploaded InputFile; media (probe result) makes it a streamable video
+    attributes = [raw.types.DocumentAttributeFilename(file_name=file_name)]
+    if media:
+        attributes.insert(0, raw.types.DocumentAttributeVideo(
+            duration=media['duration'], w=media['width'], h=media['height'], supports_streaming=True
+        ))
+    updates = await client.invoke(raw.functions.messages.SendMedia(
+        peer=await client.resolve_peer(chat_id),
+        media=raw.types.InputMediaUploadedDocument(
+            mime_type=mime_type, file=input_file, thumb=thumb, attributes=attributes
+        ),
+        random_id=client.rnd_id(),
+        **await utils.parse_text_entities(client, caption, None, None)
+    ))
+    for update in updates.updates:
+        if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+            return await Message._parse(client, update.message, {u.id: u for u in updates.users}, {c.id: c for c in updates.chats})
 
-        original_name = item['name']
-        file_id = item['id']
-        mime_type = item['mimeType']
+@contextlib.asynccontextmanager
+async def media_session(client):
+    # Parts go over a media connection of their own, as in Pyrogram's save_file: the bot's main
+    # session stays free for commands and status edits, and max_concurrent_transmissions applies
+    async with client.save_file_semaphore:
+        session = Session(client, await client.storage.dc_id(), await client.storage.auth_key(), await client.storage.test_mode(), is_media=True)
+        await session.start()
+        try: yield session
+        finally: await session.stop()
 
-        # --- FUNCTION 2: GLOBAL SKIP CHECK ---
-        # Checks if name is in the blacklist
-        if original_name.strip() in GLOBAL_SKIP_LIST:
-            await client.send_message(user_id, f"🚫 **Skipping (Blacklisted):** {original_name}")
+async def upload_stream_part(client, stream, chat_id, part_name, caption, offset, length, message):
+    status_text = f"⬆️ **Streaming:**\n`{part_name}`"
+    file_id, total_parts = client.rnd_id(), math.ceil(length / STREAM_CHUNK)
+    is_big = length > 10 * 1024 * 1024 # Telegram wants saveBigFilePart above 10 MB
+    start_time, counted, done = time.time(), [0], [0]
+
+    async def save(session, n, chunk):
+        if is_big: query = raw.functions.upload.SaveBigFilePart(file_id=file_id, file_part=n, file_total_parts=total_parts, bytes=chunk)
+        else: query = raw.functions.upload.SaveFilePart(file_id=file_id, file_part=n, bytes=chunk)
+        while True:
+            # A FloodWait only delays this part, the file carries on
+            try:
+                await session.invoke(query)
+                break
+            except FloodWait as e:
+                FLOODWAITS.labels('stream').inc()
+                FLOODWAIT_SECONDS.labels('stream').inc(e.value)
+                RETRIES.labels('stream').inc()
+                await asyncio.sleep(e.value)
+        done[0] += len(chunk)
+        await progress(done[0], length, message, start_time, status_text, counted)
+
+    if is_big: input_file = raw.types.InputFileBig(id=file_id, parts=total_parts, name=part_name)
+    else: input_file = raw.types.InputFile(id=file_id, parts=total_parts, name=part_name, md5_checksum="")
+    mime_type = client.guess_mime_type(part_name) or stream.item.get('mimeType') or "application/octet-stream"
+    async with media_session(client) as session:
+        inflight = set()
+        try:
+            for n in range(total_parts):
+                chunk = await stream.next_chunk()
+                if len(inflight) >= STREAM_PARALLEL:
+                    finished, inflight = await asyncio.wait(inflight, return_when=asyncio.FIRST_COMPLETED)
+                    for task in finished: task.result()
+                inflight.add(asyncio.create_task(save(session, n, chunk)))
+            for task in asyncio.as_completed(inflight): await task
+        finally:
+            for task in inflight: task.cancel()
+
+        while True:
+            try: return await send_uploaded_media(client, chat_id, input_file, part_name, caption, mime_type)
+            except FilePartMissing as e:
+                RETRIES.labels('stream').inc()
+                part_offset = e.value * STREAM_CHUNK
+                await save(session, e.value, await stream.fetch(offset + part_offset, min(STREAM_CHUNK, length - part_offset)))
+
+async def upload_stream(client, stream, chat_id, msg, job):
+    message_ids = []
+    file_id = stream.item['id']
+    for part_num, part_name, p_cap, byte_range in stream.parts:
+        part_key = f"{file_id}:{part_num}"
+        if part_num and job.journal.done('part', part_key):
+            message_ids.append(int(job.journal.value('part', part_key)))
             continue
+        if job.stopped: raise Exception("Stopped")
+        offset, length = byte_range or (0, int(stream.item['size']))
+        with STAGE_SECONDS.labels('upload').time():
+            sent = await upload_stream_part(client, stream, chat_id, part_name, p_cap, offset, length, msg)
+        dedup_record(stream.item, part_num, sent)
+        message_ids.append(sent.id)
+        if part_num: job.journal.mark('part', part_key, sent.id)
+
+    result = checksum_status(stream.item, stream.md5.hexdigest() if stream.md5 else None, stream.hashed)
+    checksum_record(stream.item, result)
+    if result == 'mismatch':
+        # Already on Telegram but not what Drive has: take it down so the next run sends it again
+        RETRIES.labels('verify').inc()
+        dedup_forget(stream.item)
+        for part_num, *_ in stream.parts: job.journal.unmark('part', f"{file_id}:{part_num}")
+        try: await client.delete_messages(chat_id, message_ids)
+        except Exception as e: print(f"Mismatch Cleanup Error: {e}")
+        raise Exception("Checksum mismatch: streamed bytes don't match Drive's md5, upload removed")
+    return message_ids
+
+# --- TRANSFER PIPELINE ---
+# Producer (recursive_process) starts downloads up to PREFETCH_DEPTH files ahead,
+# consumer (run) uploads them strictly in the order they were queued.
+class TransferPipeline:
+    def __init__(self, client, job, depth=PREFETCH_DEPTH):
+        self.client = client
+        self.job = job
+        self.journal = job.journal
+        self.user_id = job.user_id
+        self.chat_id = job.chat_id
+        self.sync = job.journal.sync
+        self.unchanged = 0
+        self.errors = 0
+        self.folder_errors = {}
+        self.queue = asyncio.Queue()
+        self.slots = asyncio.Semaphore(depth)
+        self.plan = None
+        self.sent_files = 0
+        self.sent_bytes = 0
+        self.started = time.time()
+        self.batch = None # Small files waiting to go out as one media group
+
+    def report(self):
+        # Overall progress lives in the job's own status message
+        if not self.plan: return
+        elapsed = max(time.time() - self.started, 0.001)
+        status.edit(self.job.message, f"🚀 **Job #{self.job.job_id}**\n\n{self.plan.summary()}\n\n{self.plan.progress(self.sent_files, self.sent_bytes, elapsed)}")
+
+    async def add_folder(self, key, text, name=None, pin=False):
+        # name=None -> header is not added to the job's folder index
+        await self.flush_batch()
+        await self.queue.put({'type': 'folder', 'key': key, 'text': text, 'name': name, 'pin': pin})
+
+    # A folder is checkpointed once the uploader has passed the end of its subtree with no errors
+    async def begin_folder(self, folder_id):
+        await self.flush_batch()
+        await self.queue.put({'type': 'begin', 'id': folder_id})
+
+    async def end_folder(self, folder_id):
+        await self.flush_batch()
+        await self.queue.put({'type': 'end', 'id': folder_id})
 
-        # --- START FROM CHECK ---
-        if SKIP_UNTIL_NAME and not FOUND_START_FILE:
-            if mime_type != 'application/vnd.google-apps.folder':
-                if original_name.strip() == SKIP_UNTIL_NAME.strip():
-                    FOUND_START_FILE = True 
-                    await client.send_message(user_id, f"✅ **Found Start Point:** {original_name}\nResuming Download...")
-                else:
+    def is_unchanged(self, item):
+        if not self.sync or not manifest_is_current(item, self.chat_id): return False
+        self.unchanged += 1
+        return True
+
+    def batch_kind(self, item):
+        # Consecutive small files of one folder share a media group; videos and documents can't mix
+        size = int(item.get('size') or 0)
+        if not BATCH_FILE_LIMIT or not size or size > BATCH_FILE_LIMIT or dedup_lookup(item): return None
+        return 'video' if is_video(item['name']) else 'document'
+
+    async def add_file(self, item, parent_path, caption, message):
+        if not downloadable(item):
+            await self.client.send_message(self.user_id, f"📝 **Skipping (not downloadable):** {item['name']}")
+            return
+        kind = self.batch_kind(item)
+        if self.batch and (kind != self.batch['kind'] or parent_path != self.batch['path']): await self.flush_batch()
+        if not kind: return await self.queue_file(item, parent_path, caption, message)
+        if not self.batch: self.batch = {'kind': kind, 'path': parent_path, 'message': message, 'files': []}
+        self.batch['files'].append((item, caption))
+        if len(self.batch['files']) == BATCH_SIZE: await self.flush_batch()
+
+    async def flush_batch(self):
+        batch, self.batch = self.batch, None
+        if not batch: return
+        if len(batch['files']) == 1:
+            item, caption = batch['files'][0]
+            return await self.queue_file(item, batch['path'], caption, batch['message'])
+        await self.queue_batch(batch['files'], batch['path'], batch['message'])
+
+    async def queue_batch(self, files, parent_path, message):
+        await self.job.wait_if_paused()
+        await self.slots.acquire()
+        if self.job.stopped:
+            self.slots.release()
+            return
+        msg = await message.reply_text(f"⏳ **Queued:** {len(files)} files\n`{files[0][0]['name']}` ...")
+        members = []
+        for item, caption in files:
+            key = self.storage_key(item)
+            # A file that can't get space is queued as failed, so the consumer counts it in its folder
+            try: reserved = await storage.reserve(key, int(item['size']), storage.path_for(key), msg, self.job)
+            except StorageError as e:
+                members.append({'item': item, 'caption': caption, 'task': None, 'error': e})
+                continue
+            if reserved: members.append({'item': item, 'caption': caption, 'task': asyncio.create_task(self.prepare(item, caption, msg, ahead=False))})
+        if not members:
+            self.slots.release()
+            await status.delete(msg)
+            return
+        await self.queue.put({'type': 'batch', 'path': parent_path, 'msg': msg, 'members': members})
+
+    async def queue_file(self, item, parent_path, caption, message):
+        await self.job.wait_if_paused()
+        await self.slots.acquire()
+        if self.job.stopped:
+            self.slots.release()
+            return
+        msg = await message.reply_text(f"⏳ **Queued:** {item['name']}")
+        # Content uploaded before is re-sent by file_id: no download, no disk
+        cached = dedup_lookup(item)
+        task, error = None, None
+        if not cached:
+            # A file that can't get space is queued as failed, so the consumer counts it in its folder
+            try: task = await self.start_transfer(item, caption, msg)
+            except StorageError as e: error = e
+            if task is None and error is None:
+                self.slots.release()
+                await status.delete(msg)
+                return
+        await self.queue.put({'type': 'file', 'item': item, 'path': parent_path, 'caption': caption, 'msg': msg, 'task': task, 'cached': cached, 'error': error})
+
+    async def start_transfer(self, item, caption, msg, wait=True):
+        # The prepare() task, or for streamed files a DriveStream; None if the job stopped while waiting.
+        # Reserved in queue order, so a job never waits on space held by its own later files
+        key = self.storage_key(item)
+        if not await storage.reserve(key, storage.reserve_size(item), storage.path_for(key), msg, self.job, wait): return None
+        if streamable(item):
+            # Starts filling its buffer now, uploads when it's this file's turn
+            stream = DriveStream(item, caption, self.job)
+            stream.start()
+            return stream
+        return asyncio.create_task(self.prepare(item, caption, msg))
+
+    def storage_key(self, item):
+        return (self.job.job_id, item['id'])
+
+    async def discard(self, item):
+        temp_path = storage.path_for(self.storage_key(item))
+        # The thumbnail of a video probed without an md5 sits next to it (see probe_media);
+        # a download aria2 ended with an error leaves its control file behind
+        for path in (temp_path, f"{temp_path}.jpg", f"{temp_path}.aria2"):
+            if os.path.exists(path): os.remove(path)
+        await storage.release(self.storage_key(item))
+
+    async def download(self, item, msg):
+        # With VERIFY_DOWNLOADS a file whose md5/size doesn't match Drive is fetched again
+        attempt, switches = 0, 0
+        while attempt <= VERIFY_RETRIES:
+            hasher = PrefixHasher(storage.path_for(self.storage_key(item))) if VERIFY_DOWNLOADS and item.get('md5Checksum') else None
+            async with DOWNLOAD_SLOTS.slot(self.job.job_id):
+                # Each download goes to the least used account; a limited one is swapped out, not retried
+                creds = accounts.pick().creds
+                try:
+                    with STAGE_SECONDS.labels('download').time():
+                        temp_path = await download_with_aria2(item['id'], item['name'], msg, creds, self.job, item.get('size'), hasher)
+                except DriveLimitError as e:
+                    accounts.rest(creds, e)
+                    # One file never drains the whole pool
+                    switches += 1
+                    if switches > ACCOUNT_SWITCHES: raise
+                    RETRIES.labels('download').inc()
+                    status.edit(msg, f"🔁 **Drive limit hit, switching account:**\n`{item['name']}`")
                     continue
+            accounts.record(creds, os.path.getsize(temp_path))
+            attempt += 1
+            if not hasher:
+                checksum_record(item, 'unchecked')
+                return temp_path
+            result = checksum_status(item, *await hasher.finish())
+            checksum_record(item, result)
+            if result == 'verified': return temp_path
+            os.remove(temp_path)
+            RETRIES.labels('verify').inc()
+            status.edit(msg, f"⚠️ **Checksum mismatch, downloading again:**\n`{item['name']}`")
+        raise Exception(f"Checksum mismatch: download doesn't match Drive's md5 after {VERIFY_RETRIES + 1} attempts")
 
-        # --- FOLDER HANDLING ---
-        if mime_type == 'application/vnd.google-apps.folder':
-            full_folder_name = f"📂 {parent_path}{original_name}"
-            
-            if not SKIP_UNTIL_NAME or FOUND_START_FILE:
-                sent_msg = await client.send_message(chat_id, f"**{full_folder_name}**")
-                
-                # Pin ONLY if Root Selection
-                if is_root_selection:
-                    try: await client.pin_chat_message(chat_id, sent_msg.id)
-                    except: pass
-                
-                clean_cid = str(chat_id).replace("-100", "")
-                msg_link = f"https://t.me/c/{clean_cid}/{sent_msg.id}"
-                FOLDER_INDEX.append(f"[{original_name}]({msg_link})")
+    async def prepare(self, item, caption, msg, ahead=True):
+        # Runs ahead of the in-order consumer: download, probe, then (UPLOAD_AHEAD) upload the bytes
+        temp_path = await self.download(item, msg)
+        media = None
+        if is_video(item['name']) and os.path.getsize(temp_path) <= SPLIT_LIMIT:
+            media = await probe_media(temp_path, item.get('md5Checksum'))
+        uploaded = None
+        # Segments are cut while uploading, so they go through the direct path
+        if ahead and UPLOAD_AHEAD and not needs_segments(item):
+            uploaded = await upload_ahead(self.client, temp_path, item, caption, msg, self.job, media)
+        return temp_path, media, uploaded
 
-            # Recursive call
-            await recursive_process(client, service, creds, file_id, user_id, message, parent_path + original_name + " / ", is_root_selection=False)
-        
-        # --- FILE HANDLING ---
-        else:
-            if SKIP_UNTIL_NAME and not FOUND_START_FILE: continue
+    async def close(self):
+        await self.flush_batch()
+        await self.queue.put(None)
+
+    async def run(self):
+        while True:
+            entry = await self.queue.get()
+            if entry is None: return
+            if entry['type'] == 'begin':
+                self.folder_errors[entry['id']] = self.errors
+                continue
+            if entry['type'] == 'end':
+                if not self.job.stopped and self.folder_errors.pop(entry['id'], None) == self.errors:
+                    self.journal.mark('folder', entry['id'])
+                continue
+            if entry['type'] == 'folder':
+                if self.job.stopped or self.journal.done('header', entry['key']): continue
+                try: await self.post_folder(entry)
+                except Exception as e: print(f"Folder Post Error: {e}")
+                continue
+            await self.job.wait_if_paused()
+            try:
+                if entry['type'] == 'batch': await self.finish_batch(entry)
+                else: await self.finish_file(entry)
+            except Exception as e:
+                # e.g. the error report itself hit a long FloodWait: the uploader must keep going,
+                # or the producer waits on a slot forever. Counted so the folder isn't checkpointed.
+                self.errors += 1
+                print(f"Upload Entry Error: {e}")
+            finally: self.slots.release()
 
-            msg = await message.reply_text(f"⏳ **Queued:** {original_name}")
+    async def post_folder(self, entry):
+        sent_msg = await self.client.send_message(self.chat_id, entry['text'])
+        if entry['pin']:
+            try: await self.client.pin_chat_message(self.chat_id, sent_msg.id)
+            except: pass
+        index_line = ""
+        if entry['name']:
+            clean_cid = str(self.chat_id).replace("-100", "")
+            msg_link = f"https://t.me/c/{clean_cid}/{sent_msg.id}"
+            index_line = f"[{entry['name']}]({msg_link})"
+            self.job.folder_index.append(index_line)
+        self.journal.mark('header', entry['key'], index_line)
+
+    async def finish_file(self, entry):
+        item, msg, task = entry['item'], entry['msg'], entry['task']
+        name = item['name']
+        if self.job.stopped:
+            if isinstance(task, DriveStream): task.close()
+            elif task:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+            await self.discard(item)
+            await status.delete(msg)
+            return
+        try:
+            if entry['error']: raise entry['error']
+            if entry['cached']:
+                try: message_ids = await send_cached(self.client, entry['cached'], item, self.chat_id, entry['caption'], msg, self.job)
+                except Exception as e:
+                    if self.job.stopped: raise
+                    # Stale file_id/message: forget it and transfer the file after all. Only if the space
+                    # is free right now: later files hold theirs until this one is done, so waiting here
+                    # would never end; without it the file fails and /resume transfers it.
+                    print(f"Dedup Error: {e}")
+                    dedup_forget(item)
+                    task = await self.start_transfer(item, entry['caption'], msg, wait=False)
+                    if task is None: return await status.delete(msg)
+            if isinstance(task, DriveStream):
+                async with UPLOAD_SLOTS.slot(self.job.job_id):
+                    message_ids = await upload_stream(self.client, task, self.chat_id, msg, self.job)
+            elif task:
+                temp_path, media, uploaded = await task
+                message_ids = None
+                if uploaded is not None:
+                    try: message_ids = await publish_uploaded(self.client, uploaded, self.chat_id, self.job, item, media)
+                    except Exception as e:
+                        if self.job.stopped: raise
+                        # e.g. Telegram dropped the uploaded parts: send what's left the direct way
+                        print(f"Publish Error: {e}")
+                        RETRIES.labels('upload').inc()
+                if message_ids is None:
+                    async with UPLOAD_SLOTS.slot(self.job.job_id):
+                        message_ids = await upload_downloaded(self.client, temp_path, name, self.chat_id, entry['caption'], msg, self.job, item, media)
+            manifest_record(item, self.chat_id, entry['path'], message_ids)
+            dedup_seal(item, len(message_ids))
+            self.journal.mark('file', item['id'])
+            await self.discard(item)
+            await status.delete(msg)
+        except (Exception, asyncio.CancelledError) as e:
+            if isinstance(task, DriveStream): task.close()
+            await self.discard(item)
+            if not self.job.stopped and not isinstance(e, asyncio.CancelledError):
+                self.errors += 1
+                await self.client.send_message(self.user_id, f"❌ Error: {name}\n{str(e)}")
+            await status.delete(msg)
+        if not self.job.stopped:
+            self.sent_files += 1
+            self.sent_bytes += int(item.get('size') or 0)
+            self.report()
+
+    async def finish_batch(self, entry):
+        msg, members = entry['msg'], entry['members']
+        tasks = [m['task'] for m in members if m['task']]
+        if self.job.stopped:
+            for task in tasks: task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for member in members: await self.discard(member['item'])
+            await status.delete(msg)
+            return
+        ready = []
+        for member in members:
             try:
-                temp_path = await download_with_aria2(file_id, original_name, msg, creds)
+                if member.get('error'): raise member['error']
+                member['path'], member['media'], _ = await member['task']
+                ready.append(member)
+            except Exception as e:
+                await self.discard(member['item'])
+                if not self.job.stopped:
+                    self.errors += 1
+                    await self.client.send_message(self.user_id, f"❌ Error: {member['item']['name']}\n{str(e)}")
+        try:
+            if ready and not self.job.stopped:
+                async with UPLOAD_SLOTS.slot(self.job.job_id):
+                    try: sent = await upload_group(self.client, ready, self.chat_id, msg)
+                    except Exception as e:
+                        if self.job.stopped: raise
+                        # One bad file shouldn't sink the rest: send them one by one
+                        print(f"Media Group Error: {e}")
+                        sent = [None] * len(ready)
+                for member, message in zip(ready, sent):
+                    await self.finish_member(member, entry['path'], message, msg)
+        finally:
+            for member in ready: await self.discard(member['item'])
+            await status.delete(msg)
+
+    async def finish_member(self, member, parent_path, message, msg):
+        item = member['item']
+        try:
+            if message: message_ids = [message.id]
+            else: message_ids = await upload_downloaded(self.client, member['path'], item['name'], self.chat_id, member['caption'], msg, self.job, item, member['media'])
+            manifest_record(item, self.chat_id, parent_path, message_ids)
+            dedup_seal(item, len(message_ids))
+            self.journal.mark('file', item['id'])
+        except Exception as e:
+            if self.job.stopped: return
+            self.errors += 1
+            await self.client.send_message(self.user_id, f"❌ Error: {item['name']}\n{str(e)}")
+        self.sent_files += 1
+        self.sent_bytes += int(item.get('size') or 0)
+        self.report()
+
+def split_plan(f_size, original_name, final_caption):
+    # [(part_num, display_name, caption, byte_range)]; part_num/byte_range are None when no split is needed.
+    # Each part is an offset/length view of the download: no read into RAM, no _partN copy.
+    if f_size <= SPLIT_LIMIT: return [(None, original_name, final_caption, None)]
+    return [
+        (part_num, f"{original_name}.part{part_num}", f"{final_caption}\n\n**Part {part_num}**", (offset, min(SPLIT_LIMIT, f_size - offset)))
+        for part_num, offset in enumerate(range(0, f_size, SPLIT_LIMIT), start=1)
+    ]
+
+async def upload_downloaded(client, temp_path, original_name, chat_id, final_caption, msg, job=None, item=None, media=None):
+    if item and needs_segments(item): return await upload_segments(client, temp_path, item, chat_id, final_caption, msg, job)
+    journal = job.journal if job else None
+    file_id = item['id'] if item else None
+    f_size = os.path.getsize(temp_path)
+    parts = split_plan(f_size, original_name, final_caption)
+    if len(parts) > 1: status.edit(msg, f"✂️ **Splitting File:** {humanbytes(f_size)}")
+
+    message_ids = []
+    for part_num, part_name, p_cap, byte_range in parts:
+        if job and job.stopped: raise Exception("Stopped")
+        part_key = f"{file_id}:{part_num}"
+        if part_num and journal and journal.done('part', part_key):
+            message_ids.append(int(journal.value('part', part_key)))
+            continue
+        sent = await upload_file(client, temp_path, part_name, chat_id, p_cap, msg, is_part=bool(part_num), byte_range=byte_range, media=media)
+        dedup_record(item, part_num, sent)
+        message_ids.append(sent.id)
+        if part_num and journal: journal.mark('part', part_key, sent.id)
+    return message_ids
+
+async def save_upload(client, file_path, display_name, byte_range, message, media=None):
+    # Just the upload: an InputFile (plus thumbnail) to post later, no message yet
+    status_text = f"⬆️ **Uploading:**\n`{display_name}`"
+    source = FileSlice(file_path, *(byte_range or (0, os.path.getsize(file_path))), display_name)
+    try:
+        with STAGE_SECONDS.labels('upload').time():
+            input_file = await client.save_file(source, progress=progress, progress_args=(message, time.time(), status_text, [0]))
+            thumb = await client.save_file(media['thumb']) if media and media['thumb'] else None
+    finally: source.close()
+    # save_file logs transfer errors and returns None
+    if input_file is None: raise Exception(f"Upload Failed: {display_name}")
+    return input_file, thumb
+
+async def upload_ahead(client, temp_path, item, final_caption, msg, job, media=None):
+    # Every part not yet posted is uploaded at once, each over its own media session, while
+    # the file waits for its turn; publish_uploaded then posts them in order
+    f_size = os.path.getsize(temp_path)
+    parts = split_plan(f_size, item['name'], final_caption)
+    if len(parts) > 1: status.edit(msg, f"✂️ **Splitting File:** {humanbytes(f_size)}")
+
+    async def upload(part_num, part_name, p_cap, byte_range):
+        if part_num and job.journal.done('part', f"{item['id']}:{part_num}"): return part_num, part_name, p_cap, None, None
+        async with UPLOAD_SLOTS.slot(job.job_id):
+            if job.stopped: raise Exception("Stopped")
+            input_file, thumb = await save_upload(client, temp_path, part_name, byte_range, msg, None if part_num else media)
+        return part_num, part_name, p_cap, input_file, thumb
+
+    return await asyncio.gather(*(upload(*part) for part in parts))
+
+async def publish_uploaded(client, uploaded, chat_id, job, item, media=None):
+    # Posts the parts of upload_ahead in order with messages.SendMedia
+    message_ids = []
+    for part_num, part_name, p_cap, input_file, thumb in uploaded:
+        part_key = f"{item['id']}:{part_num}"
+        if input_file is None or (part_num and job.journal.done('part', part_key)):
+            message_ids.append(int(job.journal.value('part', part_key)))
+            continue
+        if job.stopped: raise Exception("Stopped")
+        video = media if not part_num and is_video(part_name) else None
+        mime_type = client.guess_mime_type(part_name) or ("video/mp4" if video else item.get('mimeType') or "application/octet-stream")
+        sent = await send_uploaded_media(client, chat_id, input_file, part_name, p_cap, mime_type, thumb, video)
+        dedup_record(item, part_num, sent)
+        message_ids.append(sent.id)
+        if part_num: job.journal.mark('part', part_key, sent.id)
+    return message_ids
+
+async def send_cached(client, cached, item, chat_id, final_caption, msg, job):
+    # Content already on Telegram: each part is re-sent by file_id (or copied), nothing is transferred
+    status.edit(msg, f"♻️ **Already on Telegram:**\n`{item['name']}`")
+    message_ids = []
+    for part_num in sorted(cached):
+        p_cap = f"{final_caption}\n\n**Part {part_num}**" if part_num else final_caption
+        part_key = f"{item['id']}:{part_num}"
+        if part_num and job.journal.done('part', part_key):
+            message_ids.append(int(job.journal.value('part', part_key)))
+            continue
+        if job.stopped: raise Exception("Stopped")
+        file_id, source_chat, source_id = cached[part_num]
+        try: sent = await client.send_cached_media(chat_id, file_id, caption=p_cap)
+        except Exception as e:
+            print(f"Cached Send Error: {e}")
+            sent = await client.copy_message(chat_id, int(source_chat), source_id, caption=p_cap)
+        DEDUP_HITS.inc()
+        message_ids.append(sent.id)
+        if part_num: job.journal.mark('part', part_key, sent.id)
+    return message_ids
+
+# --- VIDEO SEGMENTS ---
+# Videos over SPLIT_LIMIT are cut on keyframes with ffmpeg stream copy (no re-encode)
+# into playable segments. Each segment is probed and uploaded as a streamable video as
+# soon as ffmpeg has finished it, while the following ones are still being written.
+def needs_segments(item):
+    return VIDEO_SPLIT and is_video(item['name']) and int(item.get('size') or 0) > SPLIT_LIMIT
+
+async def probe_duration(path):
+    _, out = await run_tool("ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "json", path)
+    try: return float(json.loads(out or b"{}").get('format', {}).get('duration') or 0)
+    except (ValueError, TypeError): return 0
+
+async def video_segments(path, ext):
+    # Yields finished segment paths in order; ffmpeg appends each to the csv list once it's closed
+    size, duration = os.path.getsize(path), await probe_duration(path)
+    if not duration: raise Exception("Can't read video duration for splitting")
+    # Average-bitrate estimate with 10% slack, since cuts land on the next keyframe
+    segment_time = max(1.0, duration * SPLIT_LIMIT * 0.9 / size)
+    out_dir = f"{path}_segments"
+    os.makedirs(out_dir, exist_ok=True)
+    list_path = os.path.join(out_dir, "segments.csv")
+    process = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-v", "error", "-y", "-i", path, "-map", "0:v:0", "-map", "0:a?", "-c", "copy",
+        "-f", "segment", "-segment_time", f"{segment_time:.3f}", "-reset_timestamps", "1",
+        "-segment_list", list_path, "-segment_list_type", "csv", os.path.join(out_dir, f"segment%03d{ext}"),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    started, listed = time.time(), 0
+    try:
+        while True:
+            finished = process.returncode is not None
+            if os.path.exists(list_path):
+                with open(list_path) as f: names = [line.split(",")[0] for line in f.read().splitlines() if line]
+                for name in names[listed:]: yield os.path.join(out_dir, name)
+                listed = len(names)
+            if finished: break
+            await asyncio.sleep(1)
+        if process.returncode != 0: raise Exception(f"ffmpeg segmenting failed (exit {process.returncode})")
+        STAGE_SECONDS.labels('split').observe(time.time() - started)
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+async def sized_segments(path, ext, depth=0):
+    # video_segments cuts by average bitrate, so a busy stretch of a VBR video can still come out
+    # over SPLIT_LIMIT: such a segment is cut again by its own (higher) bitrate. A keyframe interval
+    # that still doesn't fit is sent as byte ranges. Yields (path, byte_range), deletes each when done.
+    async with contextlib.aclosing(video_segments(path, ext)) as segments:
+        async for segment in segments:
+            size = os.path.getsize(segment)
+            if size <= SPLIT_LIMIT: yield segment, None
+            elif depth < 2:
+                async with contextlib.aclosing(sized_segments(segment, ext, depth + 1)) as pieces:
+                    async for piece in pieces: yield piece
+            else:
+                for offset in range(0, size, SPLIT_LIMIT): yield segment, (offset, min(SPLIT_LIMIT, size - offset))
+            os.remove(segment)
+
+async def upload_segments(client, temp_path, item, chat_id, final_caption, msg, job=None):
+    journal = job.journal if job else None
+    stem, ext = os.path.splitext(item['name'])
+    status.edit(msg, f"✂️ **Splitting Video:** {humanbytes(os.path.getsize(temp_path))}")
+    message_ids = []
+    async with contextlib.aclosing(sized_segments(temp_path, ext)) as segments:
+        part_num = 0
+        async for segment, byte_range in segments:
+            part_num += 1
+            part_key = f"{item['id']}:{part_num}"
+            if journal and journal.done('part', part_key):
+                message_ids.append(int(journal.value('part', part_key)))
+                continue
+            if job and job.stopped: raise Exception("Stopped")
+            p_cap = f"{final_caption}\n\n**Part {part_num}**"
+            if byte_range:
+                # Named like a byte-range part, so it goes out as a document
+                sent = await upload_file(client, segment, f"{item['name']}.part{part_num}", chat_id, p_cap, msg, is_part=True, byte_range=byte_range)
+            else:
+                media = await probe_media(segment)
+                sent = await upload_file(client, segment, f"{stem}.part{part_num}{ext}", chat_id, p_cap, msg, media=media)
+            dedup_record(item, part_num, sent)
+            message_ids.append(sent.id)
+            if journal: journal.mark('part', part_key, sent.id)
+    return message_ids
+
+async def upload_group(client, members, chat_id, msg):
+    # Up to BATCH_SIZE small files in one send_media_group call, captions and order kept
+    status.edit(msg, f"⬆️ **Uploading {len(members)} files as a group:**\n`{members[0]['item']['name']}` ...")
+    group = []
+    for member in members:
+        item, media = member['item'], member['media']
+        # Named file objects, so Telegram shows the Drive name rather than temp_<id>
+        source = upload_source(member['path'], item['name'], (0, os.path.getsize(member['path'])))
+        if is_video(item['name']) and media:
+            group.append(InputMediaVideo(source, thumb=media['thumb'], caption=member['caption'], width=media['width'],
+                                         height=media['height'], duration=media['duration'], supports_streaming=True))
+        else: group.append(InputMediaDocument(source, caption=member['caption']))
+    try:
+        with STAGE_SECONDS.labels('upload').time():
+            sent = await client.send_media_group(chat_id, group)
+    finally:
+        for media in group: media.media.close()
+    UPLOADED_BYTES.inc(sum(os.path.getsize(m['path']) for m in members))
+    for member, message in zip(members, sent): dedup_record(member['item'], None, message)
+    return sent
+
+# --- JOB PLANNER ---
+# Listing-only pass over a selection: what will be sent, how big it is, how many files
+# need splitting and what the skip list removes. Nothing is downloaded.
+class JobPlan:
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.split_files = 0
+        self.parts = 0
+        self.folders = 0
+        self.skipped_entries = 0 # Files/folders matched by the skip list
+        self.skipped_files = 0 # Files removed by it, including everything under skipped folders
+        self.skipped_bytes = 0
+        self.done_files = 0 # Finished by an earlier run, or unchanged in sync mode
+        self.done_bytes = 0
+        self.undownloadable = 0 # Google Docs etc., skipped by the pipeline
+        self.listings = {} # Folder listings, reused by the transfer walk
+
+    def add_file(self, item):
+        if not downloadable(item):
+            self.undownloadable += 1
+            return
+        size = int(item.get('size') or 0)
+        self.files += 1
+        self.bytes += size
+        # Video segments target 90% of the limit (see video_segments), so this is an estimate for them
+        parts = max(math.ceil(size / (SPLIT_LIMIT * 0.9 if needs_segments(item) else SPLIT_LIMIT)), 1)
+        if parts > 1: self.split_files += 1
+        self.parts += parts
+
+    def summary(self):
+        text = (
+            f"🧮 **Plan:** {self.files} files, {humanbytes(self.bytes) or '0 B'} in {self.folders} folders\n"
+            f"✂️ **Split:** {self.split_files} files over {humanbytes(SPLIT_LIMIT)} → {self.parts} uploads"
+        )
+        if self.skipped_entries:
+            text += f"\n🚫 **Skip list:** {self.skipped_entries} matches, removes {self.skipped_files} files ({humanbytes(self.skipped_bytes) or '0 B'})"
+        if self.done_files:
+            text += f"\n♻️ **Already there:** {self.done_files} files ({humanbytes(self.done_bytes) or '0 B'})"
+        if self.undownloadable:
+            text += f"\n📝 **Not downloadable:** {self.undownloadable} Google Docs/shortcuts/locked files, skipped"
+        return text
+
+    def progress(self, files, size, elapsed):
+        percentage = size * 100 / self.bytes if self.bytes else 100
+        filled_length = int(10 * percentage // 100)
+        bar = '▰' * filled_length + '▱' * (10 - filled_length)
+        eta = "calculating..."
+        if size and self.bytes > size: eta = time_formatter((self.bytes - size) / (size / elapsed) * 1000) or "0s"
+        return (
+            f"📊 **Overall:** **{bar}** {round(percentage, 1)}%\n"
+            f"📄 **Files:** {files} / {self.files}\n"
+            f"📦 **Size:** {humanbytes(size) or '0 B'} / {humanbytes(self.bytes) or '0 B'}\n"
+            f"⏱ **ETA:** {eta}"
+        )
+
+async def plan_job(items, skip_list, sync=False, chat_id=None, journal=None):
+    # Mirrors run_job/recursive_process: same skip, resume and sync rules
+    plan = JobPlan()
+    already_sent = lambda item: (journal and journal.done('file', item['id'])) or (sync and manifest_is_current(item, chat_id))
+    for name, info in items:
+        if name in skip_list:
+            plan.skipped_entries += 1
+            if info['mimeType'] != FOLDER_MIME:
+                plan.skipped_files += 1
+                plan.skipped_bytes += int(info.get('size') or 0)
+                continue
+        elif journal and (journal.done('folder', info['id']) or journal.done('file', info['id'])): continue
+        if info['mimeType'] != FOLDER_MIME:
+            if already_sent(info):
+                plan.done_files += 1
+                plan.done_bytes += int(info.get('size') or 0)
+            else: plan.add_file(info)
+            continue
+
+        # Skipped subtrees are still listed so their size can be reported
+        skipped_at = 0 if name in skip_list else None # Depth of the innermost skipped folder we are in
+        if skipped_at is None: plan.folders += 1
+        prune = lambda item: bool(journal and journal.done('folder', item['id']))
+        async with contextlib.aclosing(walk_drive_tree(info['id'], prune, cache=plan.listings)) as entries:
+            async for _, depth, item in entries:
+                depth += 1
+                if skipped_at is not None and depth <= skipped_at: skipped_at = None
+                if skipped_at is None and item['name'].strip() in skip_list:
+                    plan.skipped_entries += 1
+                    if item['mimeType'] == FOLDER_MIME: skipped_at = depth
+                    else:
+                        plan.skipped_files += 1
+                        plan.skipped_bytes += int(item.get('size') or 0)
+                    continue
+                if skipped_at is not None:
+                    if item['mimeType'] != FOLDER_MIME:
+                        plan.skipped_files += 1
+                        plan.skipped_bytes += int(item.get('size') or 0)
+                    continue
+                if journal and journal.done('folder', item['id']): continue
+                if item['mimeType'] == FOLDER_MIME: plan.folders += 1
+                elif already_sent(item):
+                    plan.done_files += 1
+                    plan.done_bytes += int(item.get('size') or 0)
+                else: plan.add_file(item)
+    return plan
+
+# --- RECURSIVE CORE ---
+async def recursive_process(pipeline, folder_id, user_id, message, is_root_selection=False, root_name=None):
+    job = pipeline.job
+    if job.stopped: return
+    client = pipeline.client
+    journal = pipeline.journal
+
+    # In sync mode folder headers wait until a new/changed file shows up beneath them,
+    # so an unchanged subtree posts nothing. Entries are (depth, add_folder args).
+    pending_folders = []
+    async def queue_folder(depth, *args):
+        nonlocal pending_folders
+        pending_folders = [p for p in pending_folders if p[0] < depth]
+        pending_folders.append((depth, args))
+        if not pipeline.sync: await flush_folders(depth + 1)
+
+    async def flush_folders(depth):
+        nonlocal pending_folders
+        for d, args in pending_folders:
+            if d < depth: await pipeline.add_folder(*args)
+        pending_folders = []
+
+    # Folders whose subtree we are still inside, as (depth, folder_id)
+    open_folders = [(-1, folder_id)]
+    async def close_folders(depth):
+        while open_folders and open_folders[-1][0] >= depth:
+            await pipeline.end_folder(open_folders.pop()[1])
+
+    await pipeline.begin_folder(folder_id)
+    if root_name: await queue_folder(-1, folder_id, f"📂 **{root_name}**", None, True)
+    
+    # Blacklisted folders and folders finished by an earlier run are never listed
+    prune = lambda item: item['name'].strip() in job.skip_list or journal.done('folder', item['id'])
+    listings = pipeline.plan.listings if pipeline.plan else None
+    async with contextlib.aclosing(walk_drive_tree(folder_id, prune, cache=listings)) as entries:
+        async for parent_path, depth, item in entries:
+            if job.stopped: return
+            await close_folders(depth)
+
+            original_name = item['name']
+            file_id = item['id']
+            mime_type = item['mimeType']
+
+            # --- FUNCTION 2: GLOBAL SKIP CHECK ---
+            # Checks if name is in the blacklist
+            if original_name.strip() in job.skip_list:
+                await client.send_message(user_id, f"🚫 **Skipping (Blacklisted):** {original_name}")
+                continue
+
+            # --- RESUME CHECK ---
+            if journal.done('folder', file_id) or journal.done('file', file_id): continue
+
+            # --- FOLDER HANDLING ---
+            if mime_type == FOLDER_MIME:
+                full_folder_name = f"📂 {parent_path}{original_name}"
                 
+                # Pin ONLY if Root Selection
+                await queue_folder(depth, file_id, f"**{full_folder_name}**", original_name, is_root_selection and depth == 0)
+                await pipeline.begin_folder(file_id)
+                open_folders.append((depth, file_id))
+            
+            # --- FILE HANDLING ---
+            else:
+                if pipeline.is_unchanged(item): continue
+
+                await flush_folders(depth)
                 final_caption = (f"📂 {parent_path}\n🎥 **{original_name}**")
+                await pipeline.add_file(item, parent_path, final_caption, message)
 
-                f_size = os.path.getsize(temp_path)
-                LIMIT = 1.9 * 1024 * 1024 * 1024 
-                
-                if f_size <= LIMIT:
-                    await upload_file(client, temp_path, original_name, chat_id, final_caption, msg)
-                else:
-                    await msg.edit(f"✂️ **Splitting File:** {humanbytes(f_size)}")
-                    part_num = 1
-                    with open(temp_path, 'rb') as f:
-                        while True:
-                            if STOP_PROCESS: raise Exception("Stopped")
-                            chunk = f.read(int(LIMIT))
-                            if not chunk: break
-                            part_temp = f"{temp_path}_part{part_num}"
-                            part_name = f"{original_name}.part{part_num}"
-                            with open(part_temp, 'wb') as p: p.write(chunk)
-                            p_cap = f"{final_caption}\n\n**Part {part_num}**"
-                            await upload_file(client, part_temp, part_name, chat_id, p_cap, msg, is_part=True)
-                            if os.path.exists(part_temp): os.remove(part_temp)
-                            part_num += 1
-
-                if os.path.exists(temp_path): os.remove(temp_path)
-                await msg.delete()
-            except Exception as e:
-                if "Stopped" in str(e): return
-                await client.send_message(user_id, f"❌ Error: {original_name}\n{str(e)}")
-                if os.path.exists(f"./temp_{file_id}"): os.remove(f"./temp_{file_id}")
-                await msg.delete()
+    await close_folders(-1)
+
+async def run_job(client, job):
+    journal, message = job.journal, job.message
+    uid = job.user_id
+    
+    pipeline = TransferPipeline(client, job)
+    job.pipeline = pipeline
+    uploader = asyncio.create_task(pipeline.run())
+    try:
+        status.edit(message, f"🧮 **Job #{job.job_id}: planning...**")
+        pipeline.plan = await plan_job(journal.items, job.skip_list, journal.sync, job.chat_id, journal)
+        pipeline.started = time.time()
+        pipeline.report()
+
+        for name, info in journal.items:
+            if job.stopped: break
+            
+            fid = info['id']
+            mtype = info['mimeType']
+            
+            # Global Skip Check for Root Items
+            if name in job.skip_list:
+                await client.send_message(uid, f"🚫 **Skipping (Blacklisted):** {name}")
+                continue
+            if journal.done('folder', fid) or journal.done('file', fid): continue
+
+            # If Root Item is Folder -> Pin it and Recurse
+            if mtype == FOLDER_MIME:
+                await recursive_process(pipeline, fid, uid, message, is_root_selection=True, root_name=name)
+            
+            # If Root Item is File -> Same download/split/upload path as folder contents
+            else:
+                if pipeline.is_unchanged(info): continue
+                await pipeline.add_file(info, "", f"🎥 **{name}**", message)
+    except Exception as e:
+        await client.send_message(uid, f"❌ Error: {e}")
+        job.stop()
+    finally:
+        await pipeline.close()
+        await uploader
+    
+    if job.stopped:
+        journal.set_status('stopped')
+        await client.send_message(uid, f"⏸ **Job #{job.job_id} stopped.** Continue it with `/resume {job.job_id}`")
+        return
+
+    if job.folder_index:
+        index_text = "📑 **Index:**\n\n" + "\n".join(job.folder_index)
+        if len(index_text) > 4000: index_text = index_text[:4000] + "..."
+        await client.send_message(job.chat_id, index_text)
+    if pipeline.unchanged:
+        await client.send_message(uid, f"♻️ **Sync:** {pipeline.unchanged} unchanged files skipped.")
+    journal.set_status('done')
+    await client.send_message(uid, f"✅ **Job #{job.job_id}: All Tasks Completed!**")
+
+async def submit_job(client, journal, text):
+    msg = await client.send_message(journal.user_id, text)
+    job = Job(journal, msg)
+    scheduler.submit(job)
+    if job.state == 'queued':
+        status.edit(msg, f"{text}\n🕒 Queued (position {scheduler.position(job)}), waiting for a free slot.")
+    return job
+
+async def resume_interrupted_jobs(client):
+    # Jobs still marked 'running' were cut off by a crash/restart
+    for journal in JobJournal.unfinished('running'):
+        try: await submit_job(client, journal, f"♻️ **Resuming Job #{journal.job_id} after restart...**")
+        except Exception as e: print(f"Resume Error: {e}")
 
 # --- COMMANDS ---
 
@@ -342,7 +2213,13 @@ async def set_commands(client):
     commands = [
         BotCommand("start", "Start Bot"),
         BotCommand("setchannel", "Set Target Channel"),
-        BotCommand("stop", "Stop Process"),
+        BotCommand("jobs", "List Your Jobs"),
+        BotCommand("stop", "Stop Jobs (/stop <id> for one)"),
+        BotCommand("pause", "Pause a Job (/pause <id>)"),
+        BotCommand("resume", "Resume a Paused/Stopped Job"),
+        BotCommand("sync", "Toggle Sync Mode (only new/changed files)"),
+        BotCommand("dryrun", "Toggle Dry Run (show the plan, transfer nothing)"),
+        BotCommand("accounts", "Service Account Usage"),
         BotCommand("removeid", "Remove Channel ID")
     ]
     await client.set_bot_commands(commands)
@@ -352,20 +2229,90 @@ async def set_channel(client, message):
     if len(message.command) < 2: return await message.reply_text("Usage: `/setchannel -100xxxxxxx`")
     try:
         cid = int(message.command[1])
-        save_config({"channel_id": cid})
+        config = load_config()
+        config["channel_id"] = cid
+        save_config(config)
         await message.reply_text(f"✅ Channel ID set to: `{cid}`")
     except: await message.reply_text("❌ Invalid ID format.")
 
 @bot.on_message(filters.command("removeid") & filters.private)
 async def remove_channel(client, message):
-    save_config({})
+    config = load_config()
+    config.pop("channel_id", None)
+    save_config(config)
     await message.reply_text("🗑 Channel ID removed.")
 
+@bot.on_message(filters.command("sync") & filters.private)
+async def sync_cmd(client, message):
+    if toggle_user_setting(message.from_user.id, "sync_mode"): await message.reply_text("♻️ **Sync Mode ON:** your jobs only upload new or changed files.")
+    else: await message.reply_text("📤 **Sync Mode OFF:** your jobs upload everything selected.")
+
+@bot.on_message(filters.command("dryrun") & filters.private)
+async def dryrun_cmd(client, message):
+    if toggle_user_setting(message.from_user.id, "dry_run"): await message.reply_text("🧪 **Dry Run ON:** your jobs only show their plan, nothing is transferred.")
+    else: await message.reply_text("🚀 **Dry Run OFF:** your jobs transfer files again.")
+
+def job_from_command(message):
+    # "/cmd <id>" -> the caller's job with that id (None if missing/foreign)
+    try: job = scheduler.get(int(message.command[1]))
+    except (IndexError, ValueError): return None
+    if job and job.user_id == message.from_user.id: return job
+    return None
+
+@bot.on_message(filters.command("accounts") & filters.private)
+async def accounts_cmd(client, message):
+    try: lines = accounts.usage()
+    except Exception as e: return await message.reply_text(f"❌ Error: {e}")
+    await message.reply_text(("🔑 **Service Accounts** (today, UTC):\n\n" + "\n".join(lines))[:4000])
+
+@bot.on_message(filters.command("jobs") & filters.private)
+async def jobs_cmd(client, message):
+    jobs = scheduler.jobs(message.from_user.id)
+    if not jobs: return await message.reply_text("📭 No active jobs.")
+    icons = {'running': "▶️", 'paused': "⏸", 'queued': "🕒"}
+    text = f"📋 **Your Jobs** ({len(scheduler.active)}/{scheduler.max_active} slots busy):\n\n"
+    for job in jobs:
+        names = ", ".join(name for name, _ in job.journal.items)
+        text += f"{icons[job.state]} `#{job.job_id}` {job.state} - {names}\n"
+    await message.reply_text(text[:4000])
+
 @bot.on_message(filters.command("stop") & filters.private)
 async def stop_cmd(client, message):
-    global STOP_PROCESS
-    STOP_PROCESS = True
-    await message.reply_text("🛑 Stopping...")
+    # "/stop" stops all of your jobs, "/stop <id>" just one
+    if len(message.command) < 2: jobs = scheduler.jobs(message.from_user.id)
+    else: jobs = [j for j in [job_from_command(message)] if j]
+    if not jobs: return await message.reply_text("❌ No matching job. See /jobs")
+    for job in jobs:
+        if job.state == 'queued': scheduler.cancel(job)
+        job.stop()
+    await message.reply_text(f"🛑 Stopping: {', '.join(f'#{j.job_id}' for j in jobs)}")
+
+@bot.on_message(filters.command("pause") & filters.private)
+async def pause_cmd(client, message):
+    job = job_from_command(message)
+    if not job or job.state != 'running': return await message.reply_text("Usage: `/pause <running job id>` (see /jobs)")
+    job.pause()
+    await message.reply_text(f"⏸ **Job #{job.job_id} paused.** Transfers in flight will finish; `/resume {job.job_id}` to continue.")
+
+@bot.on_message(filters.command("resume") & filters.private)
+async def resume_cmd(client, message):
+    uid = message.from_user.id
+    if len(message.command) < 2:
+        jobs = JobJournal.unfinished('stopped', uid)
+        if not jobs: return await message.reply_text("📭 No stopped jobs.")
+        text = "⏸ **Stopped Jobs:**\n\n"
+        for job in jobs: text += f"`/resume {job.job_id}` - {', '.join(name for name, _ in job.items)}\n"
+        return await message.reply_text(text[:4000])
+    job = job_from_command(message)
+    if job and job.state == 'paused':
+        job.unpause()
+        return await message.reply_text(f"▶️ **Job #{job.job_id} resumed.**")
+    try: journal = JobJournal.load(int(message.command[1]))
+    except ValueError: journal = None
+    if not journal or journal.user_id != uid or journal.status != 'stopped':
+        return await message.reply_text("❌ No stopped or paused job with that ID.")
+    journal.set_status('running')
+    await submit_job(client, journal, f"♻️ **Resuming Job #{journal.job_id}...**")
 
 @bot.on_message(filters.command("start") & filters.private)
 async def start(client, message):
@@ -393,35 +2340,38 @@ async def handle_inputs(client, message):
     if current_step == 'idle' or "drive.google.com" in text:
         try:
             folder_id = get_file_id_from_url(text)
-            service, creds = get_gdrive_service()
             msg = await message.reply_text("🔍 **Scanning for content...**")
             
-            # Modified Query: No mimeType filter (Get ALL)
-            query = f"'{folder_id}' in parents and trashed = false"
-            results = await asyncio.to_thread(service.files().list(q=query, fields="files(id, name, mimeType)").execute)
-            items = results.get('files', [])
-            items.sort(key=lambda x: natural_sort_key(x['name']))
+            # No mimeType filter (Get ALL), every page
+            items = await list_children(folder_id)
+            if not items:
+                # A link to a single file: offer just that file
+                info = await drive.get(folder_id)
+                if info['mimeType'] != FOLDER_MIME: items = [info]
 
             if not items:
                 await msg.edit("❌ Empty folder.")
                 return
 
-            # Store map {Name: {ID, Type}}
-            item_map = {i['name']: {'id': i['id'], 'mimeType': i['mimeType']} for i in items}
+            # Store map {Name: Drive item}
+            item_map = {i['name']: i for i in items}
             user_data[uid] = {'step': 'ask_selection', 'item_map': item_map}
 
             list_text = "**Found Content:**\n\n"
             for i in items:
-                icon = "📂" if i['mimeType'] == 'application/vnd.google-apps.folder' else "📄"
+                icon = "📂" if i['mimeType'] == FOLDER_MIME else "📄"
                 list_text += f"`{icon} {i['name']}`\n"
             
             list_text += "\n👇 **Copy & Send names of items to download.**"
-            await msg.edit(list_text)
+            # One-off replies go out directly, so a failure reaches the user (StatusService is for progress)
+            chunks = text_chunks(list_text)
+            await msg.edit(chunks[0])
+            for chunk in chunks[1:]: await message.reply_text(chunk)
 
         except Exception as e:
             await message.reply_text(f"❌ Error: {e}")
 
-    # STEP 2: Handle Selection -> Ask Start File
+    # STEP 2: Handle Selection -> Ask Global Skip (Function 2)
     elif current_step == 'ask_selection':
         item_map = user_data[uid].get('item_map', {})
         selected_names = text.split('\n')
@@ -438,19 +2388,6 @@ async def handle_inputs(client, message):
             return
         
         user_data[uid]['valid_items'] = valid_items
-        user_data[uid]['step'] = 'ask_start_file'
-        
-        await message.reply_text("❓ **Start from specific file?**\n- Send **File Name**\n- Send **NO**")
-
-    # STEP 3: Handle Start File -> Ask Global Skip (Function 2)
-    elif current_step == 'ask_start_file':
-        start_from = text
-        
-        if start_from.upper() == "NO":
-            user_data[uid]['start_from'] = None
-        else:
-            user_data[uid]['start_from'] = start_from
-            
         user_data[uid]['step'] = 'ask_global_skip'
         await message.reply_text(
             "🚫 **Skip any file or folder?** (Global Blacklist)\n\n"
@@ -459,96 +2396,47 @@ async def handle_inputs(client, message):
             "- Send **NO** to skip nothing."
         )
 
-    # STEP 4: Handle Skip List -> Start Process
+    # STEP 3: Handle Skip List -> Start Process
     elif current_step == 'ask_global_skip':
         skip_input = text
-        global STOP_PROCESS, FOLDER_INDEX, SKIP_UNTIL_NAME, FOUND_START_FILE, GLOBAL_SKIP_LIST
-        
-        STOP_PROCESS = False
-        FOLDER_INDEX = []
-        GLOBAL_SKIP_LIST = []
+        skip_list = []
         
         # Set Skip List
         if skip_input.upper() != "NO":
-            GLOBAL_SKIP_LIST = [x.strip() for x in skip_input.split('\n') if x.strip()]
+            skip_list = [x.strip() for x in skip_input.split('\n') if x.strip()]
             
-        # Set Start From
-        SKIP_UNTIL_NAME = user_data[uid].get('start_from')
-        FOUND_START_FILE = True if SKIP_UNTIL_NAME is None else False
-        
         valid_items = user_data[uid]['valid_items']
-        service, creds = get_gdrive_service()
-        progress_msg = await message.reply_text("🚀 **Initializing...**")
-        
-        if SKIP_UNTIL_NAME:
-             await client.send_message(message.chat.id, f"🔍 Searching for start point: `{SKIP_UNTIL_NAME}`...")
-
-        for name, info in valid_items:
-            if STOP_PROCESS: break
-            
-            fid = info['id']
-            mtype = info['mimeType']
-            
-            # Global Skip Check for Root Items
-            if name in GLOBAL_SKIP_LIST:
-                await client.send_message(message.chat.id, f"🚫 **Skipping (Blacklisted):** {name}")
-                continue
-
-            # If Root Item is Folder -> Pin it and Recurse
-            if mtype == 'application/vnd.google-apps.folder':
-                chat_id = load_config().get("channel_id")
-                sent_msg = await client.send_message(chat_id, f"📂 **{name}**")
-                try: await client.pin_chat_message(chat_id, sent_msg.id)
-                except: pass
-                
-                await recursive_process(client, service, creds, fid, uid, progress_msg, parent_path="", is_root_selection=True)
-            
-            # If Root Item is File -> Download directly (Handle as recursive but shallow)
-            else:
-                # Check Start From for Root Files
-                if SKIP_UNTIL_NAME and not FOUND_START_FILE:
-                    if name == SKIP_UNTIL_NAME:
-                        FOUND_START_FILE = True
-                        await client.send_message(uid, f"✅ **Found Start Point:** {name}")
-                    else:
-                        continue
-                
-                msg = await message.reply_text(f"⏳ **Queued:** {name}")
-                try:
-                    temp_path = await download_with_aria2(fid, name, msg, creds)
-                    final_caption = f"🎥 **{name}**"
-                    
-                    f_size = os.path.getsize(temp_path)
-                    LIMIT = 1.9 * 1024 * 1024 * 1024
-                    if f_size <= LIMIT:
-                        await upload_file(client, temp_path, name, load_config().get("channel_id"), final_caption, msg)
-                    else:
-                        # Simple split logic for root file
-                        await msg.edit("✂️ Splitting...")
-                        # ... (Reuse split logic if needed, but usually root files are handled same way)
-                        # For simplicity, calling standard upload which handles send_video/doc
-                        await upload_file(client, temp_path, name, load_config().get("channel_id"), final_caption, msg)
-                    
-                    if os.path.exists(temp_path): os.remove(temp_path)
-                    await msg.delete()
-
-                except Exception as e:
-                     await client.send_message(uid, f"❌ Error: {name}\n{e}")
-        
-        if not STOP_PROCESS:
-            if FOLDER_INDEX:
-                index_text = "📑 **Index:**\n\n" + "\n".join(FOLDER_INDEX)
-                if len(index_text) > 4000: index_text = index_text[:4000] + "..."
-                await client.send_message(load_config().get("channel_id"), index_text)
-            await message.reply_text("✅ **All Tasks Completed!**")
-        
+        sync = user_setting(uid, "sync_mode")
+        if user_setting(uid, "dry_run"):
+            # Stay on this step so another skip list can be tried
+            msg = await message.reply_text("🧮 **Planning (dry run)...**")
+            try:
+                plan = await plan_job(valid_items, skip_list, sync, config.get("channel_id"))
+                await msg.edit(f"🧪 **Dry Run**\n\n{plan.summary()}\n\nSend another skip list (or **NO**) to re-plan, /dryrun to switch off."[:4000])
+            except Exception as e:
+                await msg.edit(f"❌ Error: {e}")
+            return
+        journal = JobJournal.create(uid, config.get("channel_id"), valid_items, skip_list, sync)
         user_data[uid] = {'step': 'idle'}
+        await submit_job(client, journal, f"🚀 **Job #{journal.job_id} created.**")
 
 # --- WEB SERVER ---
 async def web_server():
     async def handle(request): return web.Response(text="Bot Running")
+
+    async def metrics(request):
+        return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+    async def healthz(request):
+        # 503 as soon as Telegram or the download engine stops answering
+        checks = {'telegram': bool(bot.is_connected), 'aria2': await aria2.alive()}
+        if checks['telegram']:
+            try: await asyncio.wait_for(bot.get_me(), 10)
+            except Exception: checks['telegram'] = False
+        return web.json_response(checks, status=200 if all(checks.values()) else 503)
+
     app = web.Application()
-    app.add_routes([web.get('/', handle)])
+    app.add_routes([web.get('/', handle), web.get('/metrics', metrics), web.get('/healthz', healthz)])
     runner = web.AppRunner(app)
     await runner.setup()
     port = int(os.environ.get("PORT", 8080))
@@ -557,10 +2445,15 @@ async def web_server():
 
 async def main():
     await web_server()
+    await aria2.start()
     await bot.start()
+    asyncio.create_task(accounts.keep_fresh())
     print("Bot Started...")
+    asyncio.create_task(resume_interrupted_jobs(bot))
     await idle()
     await bot.stop()
+    await aria2.stop()
+    await drive.close()
 
 if __name__ == "__main__":
     loop = asyncio.get_event_loop()
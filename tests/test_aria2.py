@@ -0,0 +1,208 @@
+# Aria2Engine and download_with_aria2 against a local stand-in aria2 JSON-RPC
+# server and a local HTTP file server standing in for Drive's alt=media.
+# No aria2c, Drive or Telegram account needed:
+#
+#   python -m pytest -q tests
+
+import os
+import sys
+import json
+import socket
+import asyncio
+import tempfile
+import types
+import aiohttp
+import pytest
+from aiohttp import web
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+PORT = free_port()
+SECRET = "stand-in"
+WORK_DIR = tempfile.mkdtemp(prefix="aria2_test_")
+
+# bot reads its configuration at import time
+os.environ.update({
+    'API_ID': os.environ.get('API_ID', "1"), 'API_HASH': os.environ.get('API_HASH', "test"),
+    'BOT_TOKEN': os.environ.get('BOT_TOKEN', "0:test"),
+    'MANIFEST_DB': os.path.join(WORK_DIR, "manifest.db"),
+    'SCRATCH_DIR': os.path.join(WORK_DIR, "scratch"),
+    'PROBE_CACHE_DIR': os.path.join(WORK_DIR, "probe_cache"),
+    'DRIVE_API_URL': f"http://127.0.0.1:{PORT}/drive/v3",
+    'ARIA2_RPC_URL': f"http://127.0.0.1:{PORT}/jsonrpc",
+    'ARIA2_RPC_SECRET': SECRET,
+    'ARIA2_SPAWN': "false",
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bot
+import google.oauth2.credentials
+
+CONTENT = bytes(range(256)) * 64
+QUOTA_BODY = json.dumps({'error': {'code': 403, 'message': "The download quota for this file has been exceeded.",
+                                   'errors': [{'reason': "downloadQuotaExceeded"}]}})
+LOCKED_BODY = json.dumps({'error': {'code': 403, 'message': "Only the owner can download this file.",
+                                    'errors': [{'reason': "cannotDownloadFile"}]}})
+
+# --- STAND-INS ---
+class StandIn:
+    # aria2 JSON-RPC (the methods the bot uses) plus the Drive file server on one port.
+    # addUri fetches the URL right away, so the first tellStatus already has the outcome.
+    def __init__(self):
+        self.calls = [] # (method, params without the token)
+        self.downloads = {} # gid -> tellStatus state
+        self.files = {'ok': CONTENT}
+        self.forbidden = {'quota': QUOTA_BODY, 'locked': LOCKED_BODY}
+        self.error_code = None # Forces a failed download with this aria2 error code
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post('/jsonrpc', self.rpc)
+        app.router.add_get('/drive/v3/files/{file_id}', self.media)
+        return app
+
+    async def media(self, request):
+        if not request.headers.get('Authorization', '').startswith("Bearer "): return web.Response(status=401)
+        file_id = request.match_info['file_id']
+        if file_id in self.forbidden: return web.Response(status=403, text=self.forbidden[file_id], content_type="application/json")
+        data = self.files[file_id]
+        if 'Range' not in request.headers: return web.Response(body=data)
+        start, end = request.headers['Range'].split('=')[1].split('-')
+        return web.Response(status=206, body=data[int(start):int(end) + 1])
+
+    async def rpc(self, request):
+        data = await request.json()
+        method, params = data['method'].split('.', 1)[1], data['params']
+        if params[0] != f"token:{SECRET}":
+            return web.json_response({'jsonrpc': "2.0", 'id': data['id'], 'error': {'code': 1, 'message': "Unauthorized"}})
+        self.calls.append((method, params[1:]))
+        result = await getattr(self, method)(*params[1:])
+        return web.json_response({'jsonrpc': "2.0", 'id': data['id'], 'result': result})
+
+    async def getVersion(self): return {'version': "stand-in"}
+
+    async def addUri(self, uris, options):
+        gid = f"{len(self.downloads) + 1:016x}"
+        path = os.path.join(options['dir'], options['out'])
+        headers = dict(h.split(": ", 1) for h in options['header'])
+        async with aiohttp.ClientSession() as session:
+            async with session.get(uris[0], headers=headers) as resp:
+                body = await resp.read()
+        if resp.status == 200 and not self.error_code:
+            with open(path, 'wb') as f: f.write(body)
+            self.downloads[gid] = {'status': "complete", 'totalLength': str(len(body)), 'completedLength': str(len(body))}
+        else:
+            # Like aria2: the partial file and its control file stay behind
+            for p in (path, f"{path}.aria2"): open(p, 'wb').close()
+            message = f"The response status is not successful. status={resp.status}"
+            self.downloads[gid] = {'status': "error", 'errorCode': self.error_code or "22", 'errorMessage': message,
+                                   'totalLength': "0", 'completedLength': "0"}
+        return gid
+
+    async def tellStatus(self, gid, keys):
+        state = {'downloadSpeed': "0", **self.downloads[gid]}
+        return {k: v for k, v in state.items() if k in keys}
+
+    async def changeOption(self, gid, options): return "OK"
+    async def forceRemove(self, gid): return gid
+    async def removeDownloadResult(self, gid): return "OK"
+
+class FakeMessage:
+    def __init__(self):
+        self.chat = types.SimpleNamespace(id=1)
+        self.id = 1
+    async def edit(self, text): pass
+    async def delete(self): pass
+
+def run(test):
+    # Fresh engine and Drive session per test: each test gets its own event loop
+    async def main():
+        stand_in = StandIn()
+        runner = web.AppRunner(stand_in.app())
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', PORT).start()
+        bot.aria2 = bot.Aria2Engine()
+        bot.drive = bot.DriveClient()
+        creds = google.oauth2.credentials.Credentials(token="test-token")
+        bot.accounts.accounts = [bot.ServiceAccount("test", creds)]
+        try: return await test(stand_in, creds)
+        finally:
+            await bot.aria2.stop()
+            await bot.drive.close()
+            await runner.cleanup()
+    return asyncio.run(main())
+
+def download(file_id, creds, job_id=1):
+    job = types.SimpleNamespace(job_id=job_id, stopped=False)
+    return bot.download_with_aria2(file_id, f"{file_id}.bin", FakeMessage(), creds, job)
+
+# --- TESTS ---
+def test_engine_rpc_calls():
+    async def test(stand_in, creds):
+        await bot.aria2.start()
+        url = f"{bot.DRIVE_API_URL}/files/ok?alt=media"
+        gid = await bot.aria2.add(url, bot.storage.directory, "temp_engine", ["Authorization: Bearer test-token"], len(CONTENT))
+        state = await bot.aria2.status(gid)
+        await bot.aria2.set_headers(gid, ["Authorization: Bearer renewed"])
+        await bot.aria2.remove(gid)
+        methods = [m for m, _ in stand_in.calls]
+        assert methods == ["getVersion", "addUri", "tellStatus", "changeOption", "forceRemove", "removeDownloadResult"]
+        uris, options = stand_in.calls[1][1]
+        assert uris == [url]
+        assert options['out'] == "temp_engine" and options['stream-piece-selector'] == "inorder"
+        assert state['status'] == "complete" and state['completedLength'] == str(len(CONTENT))
+        assert stand_in.calls[3][1] == [gid, {'header': ["Authorization: Bearer renewed"]}]
+        os.remove(os.path.join(bot.storage.directory, "temp_engine"))
+    run(test)
+
+def test_rpc_error_raises():
+    async def test(stand_in, creds):
+        bot.aria2.secret = "wrong"
+        with pytest.raises(bot.Aria2Error):
+            await bot.aria2.start()
+    run(test)
+
+def test_download_completes():
+    async def test(stand_in, creds):
+        path = await download('ok', creds)
+        assert path == bot.storage.path_for((1, 'ok'))
+        with open(path, 'rb') as f: assert f.read() == CONTENT
+        assert stand_in.calls[-2:] == [("forceRemove", ["0000000000000001"]), ("removeDownloadResult", ["0000000000000001"])]
+        os.remove(path)
+    run(test)
+
+def test_disk_full_is_storage_error():
+    async def test(stand_in, creds):
+        stand_in.error_code = "9"
+        with pytest.raises(bot.StorageError):
+            await download('ok', creds)
+    run(test)
+
+def test_403_quota_is_drive_limit():
+    async def test(stand_in, creds):
+        # limit_for re-reads the 403 body with a Range request
+        with pytest.raises(bot.DriveLimitError) as error:
+            await download('quota', creds)
+        assert error.value.cooldown == bot.QUOTA_COOLDOWN
+    run(test)
+
+def test_403_not_downloadable_is_not_a_limit():
+    async def test(stand_in, creds):
+        with pytest.raises(Exception, match="Forbidden") as error:
+            await download('locked', creds)
+        assert not isinstance(error.value, bot.DriveLimitError)
+    run(test)
+
+def test_discard_removes_control_file():
+    async def test(stand_in, creds):
+        with pytest.raises(Exception):
+            await download('locked', creds, job_id=7)
+        path = bot.storage.path_for((7, 'locked'))
+        assert os.path.exists(f"{path}.aria2")
+        pipeline = bot.TransferPipeline.__new__(bot.TransferPipeline)
+        pipeline.job = types.SimpleNamespace(job_id=7)
+        await pipeline.discard({'id': 'locked'})
+        assert not os.path.exists(path) and not os.path.exists(f"{path}.aria2")
+    run(test)